@@ -0,0 +1,85 @@
+import random
+import time
+from argparse import ArgumentParser
+
+from texttable import Texttable
+
+from table_solver import TableSolver
+
+
+# Builds a poll that looks roughly like ours - a few games everyone wants to
+# play, a long tail that only one or two people care about, and some attendees
+# who only thumbed-up
+def random_poll(num_attendees, num_games, rng):
+    games = [f"game_{n}" for n in range(num_games)]
+    popularity = [1 / (rank + 1) for rank in range(num_games)]
+    votes = {}
+    for user in range(num_attendees):
+        if rng.random() < 0.1:
+            votes[f"user_{user}"] = []
+            continue
+        num_votes = rng.randint(1, min(6, num_games))
+        votes[f"user_{user}"] = list(set(rng.choices(games, weights=popularity, k=num_votes)))
+    return votes
+
+
+def random_sizes(num_games, rng):
+    sizes = {}
+    for n in range(num_games):
+        low = rng.randint(2, 4)
+        sizes[f"game_{n}"] = (low, low + rng.randint(0, 4))
+    return sizes
+
+
+def run(sizes, repeats, time_budget, seed):
+    rng = random.Random(seed)
+    table = Texttable()
+    table.set_cols_align(["r", "r", "r", "r", "r", "r"])
+    table.set_cols_dtype(["i", "i", "t", "t", "t", "t"])
+    table.add_row(["attendees", "games", "first pass (ms)", f"{time_budget}s budget (ms)", "satisfied", "seated"])
+
+    for num_attendees, num_games in sizes:
+        first_times = []
+        full_times = []
+        satisfied = []
+        seated = []
+        for _ in range(repeats):
+            votes = random_poll(num_attendees, num_games, rng)
+            solver = TableSolver(random_sizes(num_games, rng), seed=rng.random())
+
+            start = time.perf_counter()
+            solver.solve(votes, max_restarts=1, time_budget=60)
+            first_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            assignment = solver.solve(votes, time_budget=time_budget)
+            full_times.append(time.perf_counter() - start)
+            satisfied.append(assignment.satisfied / num_attendees)
+            seated.append(assignment.assigned / num_attendees)
+
+        table.add_row([
+            num_attendees,
+            num_games,
+            f"{1000 * max(first_times):.1f}",
+            f"{1000 * max(full_times):.1f}",
+            f"{100 * sum(satisfied) / repeats:.0f}%",
+            f"{100 * sum(seated) / repeats:.0f}%",
+        ])
+
+    print(table.draw())
+
+
+def main():
+    parser = ArgumentParser(description="See how TableSolver scales with poll size")
+    parser.add_argument('--repeats', type=int, default=5, help="Random polls to solve at each size")
+    parser.add_argument('--time-budget', type=float, default=TableSolver.time_budget,
+                        help="Time budget to give the solver for restarts")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    sizes = [(10, 5), (20, 10), (40, 20), (60, 40), (100, 60), (200, 100)]
+    run(sizes, args.repeats, args.time_budget, args.seed)
+
+
+if __name__ == '__main__':
+    main()
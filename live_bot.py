@@ -1,36 +1,35 @@
+import asyncio
 import logging
-import parsedatetime
+import os
 import discord
-import ruamel.yaml
-import dateparser
-import random
-import json
 from datetime import datetime, timedelta
 import pytz
-from collections import defaultdict
 from pprint import pformat
-from io import BytesIO
 from aio_timers import Timer
 from discord.ext import commands
 
+from message_queue import MessageQueue
+from poll_service import PollService, vote_matrix, poll_fingerprint
+from request_scheduler import RequestScheduler
+from state_snapshot import BotSnapshot
 from table_drawer import TableDrawer
+from lru import LRUCache
+from memory_report import report_rss
 
 discord.VoiceClient.warn_nacl = False
 
 
 class LiveBot(commands.Bot):
     polling_delay = 10
-    poll_tag = "{poll}"
-    poll_image_tag = "{poll_image}"
-    poll_result_tag = "{poll_result}"
-    last_game_date_str = "last thursday"
-    next_game_date_str = "next thursday"
     next_poll_date_str = "next friday at 8:00AM"
-    thumb_up = "👍"
-    thumb_down = "👎"
-    poll_message_file = "poll_messages.yaml"
-
-    def __init__(self, guild_id, channel_name, dump_channel_name, role_id, *args, **kwargs):
+    low_memory_image_cache_size = 128
+    user_name_cache_size = 256
+    table_modes = ("image", "text")
+
+    def __init__(self, guild_id, channel_name, dump_channel_name, role_id, *args, table_server=None, state_file=None,
+                 table_solver=None, low_memory=False, rss_report_interval=None, table_mode="image", **kwargs):
+        if table_mode not in self.table_modes:
+            raise ValueError(f"Unknown table mode {table_mode!r} - expected one of {', '.join(self.table_modes)}")
         self.__guild_id = guild_id
         self.__channel_name = channel_name
         self.__dump_channel_name = dump_channel_name
@@ -40,59 +39,66 @@ class LiveBot(commands.Bot):
         self.__channel = None
         self.__dump_channel = None
         self.__poll_timer = None
-
-        intents = discord.Intents.default()
-        intents.message_content = True
-        intents.reactions = True
-        super().__init__(*args, intents=intents, **kwargs)
-
-    async def __find_poll_message(self):
-        everyone_messages = [m async for m in self.__channel.history(oldest_first=True) if self.poll_tag in m.content]
-
-        if len(everyone_messages) == 1:
-            return everyone_messages[0]
-        elif len(everyone_messages) == 0:
-            return None
-        else:
-            ret = everyone_messages[0]
-            self.__log.warning(f"Found several possible poll messages, will guess at this one: {ret}")
-            return ret
-
-    async def __create_poll_message(self):
-        cal = parsedatetime.Calendar()
-
-        last_datetime, ret = cal.parseDT(self.last_game_date_str)
-        if not ret:
-            raise RuntimeError(f"Could not parse {self.last_game_date_str} as a datetime")
-
-        next_datetime, ret = cal.parseDT(self.next_game_date_str)
-        if not ret:
-            raise RuntimeError(f"Could not parse {self.next_game_date_str} as a datetime")
-
-        if self.__role_id:
-            message_header = f"{self.poll_tag} <@&{self.__role_id}>"
+        self.__polls = None
+        self.__message_queue = MessageQueue(PollService.poll_message_file)
+        self.__scheduler = RequestScheduler()
+        self.__table_server = table_server
+        self.__table_drawer = TableDrawer(image_cache_size=self.low_memory_image_cache_size if low_memory else None)
+        self.__user_names = LRUCache(self.user_name_cache_size)
+        self.__rss_report_interval = rss_report_interval
+        self.__rss_reporter = None
+        self.__table_solver = table_solver
+        self.__table_mode = table_mode
+        self.__state_file = state_file
+        self.__poll_message_id = None
+        self.__next_reset = None
+        self.__reset_timer = None
+        self.__table_update_due = None
+        self.__published_fingerprint = None
+        self.__verified_role_id = None
+        self.__started = False
+
+        if low_memory:
+            # All we ever look at is reactions on one message, and every message
+            # we read is fetched over REST, so we don't need to hear about (or
+            # cache) members or messages at all
+            intents = discord.Intents.none()
+            intents.guilds = True
+            intents.guild_reactions = True
+            kwargs.update(
+                member_cache_flags=discord.MemberCacheFlags.none(),
+                chunk_guilds_at_startup=False,
+                max_messages=None,
+            )
         else:
-            message_header = f"{self.poll_tag} @everyone"
-        message_body, new_messages_content = self.__generate_poll_message_body(last_datetime, next_datetime)
-        message_footer = f"**Games? {next_datetime.strftime('%d/%m/%Y')}**"
-
-        message = "\n".join([message_header, message_body, "", message_footer])
-
-        ret = await self.__channel.send(message)
-        try:
-            with open(self.poll_message_file, 'w') as f:
-                f.write(ruamel.yaml.dump(new_messages_content, Dumper=ruamel.yaml.RoundTripDumper))
-        except Exception as e:
-            self.__log.error(f"Couldn't open {self.poll_mesage_file} to write the new poll message file")
-            self.__log.exception(e)
+            intents = discord.Intents.default()
+            intents.message_content = True
+            intents.reactions = True
+        super().__init__(*args, intents=intents, **kwargs)
 
-        return ret
+    async def setup_hook(self):
+        self.__scheduler.start()
+        if self.__rss_report_interval:
+            self.__rss_reporter = asyncio.ensure_future(report_rss(self.__log, self.__rss_report_interval))
+        if self.__table_server:
+            await self.__table_server.start()
+
+    async def close(self):
+        self.__save_snapshot()
+        self.__scheduler.stop()
+        if self.__rss_reporter:
+            self.__rss_reporter.cancel()
+        if self.__table_server:
+            await self.__table_server.stop()
+        await super().close()
 
     async def on_raw_reaction_remove(self, reaction_event):
         if reaction_event.message_id != self.__poll_message_id:
             return
 
-        self.__log.info(f"{reaction_event.emoji} removed")
+        # Removal events don't say who it was, so go by whoever we last saw with that ID
+        user_name = self.__user_names.get(reaction_event.user_id, f"User {reaction_event.user_id}")
+        self.__log.info(f"{user_name} removed {reaction_event.emoji}")
         await self.__handle_reaction_change(reaction_event)
 
     async def on_raw_reaction_add(self, reaction_event):
@@ -102,6 +108,7 @@ class LiveBot(commands.Bot):
         if reaction_event.message_id != self.__poll_message_id:
             return
 
+        self.__user_names[reaction_event.user_id] = reaction_event.member.name
         self.__log.info(f"{reaction_event.member.name} reacted with {reaction_event.emoji}")
         await self.__handle_reaction_change(reaction_event)
 
@@ -109,89 +116,58 @@ class LiveBot(commands.Bot):
         if reaction_event.message_id != self.__poll_message_id:
             return
 
+        self.__polls.mark_stale(reaction_event.emoji)
+        self.__schedule_table_update()
+
+    def __schedule_table_update(self, delay=None):
+        if delay is None:
+            delay = self.polling_delay
+
         if self.__poll_timer:
             self.__poll_timer.cancel()
 
-        self.__poll_timer = Timer(self.polling_delay, self.__update_poll_table, callback_async=True)
+        self.__table_update_due = datetime.now() + timedelta(seconds=delay)
+        self.__poll_timer = Timer(delay, self.__update_poll_table, callback_async=True)
 
     async def __update_poll_table(self):
         self.__log.info("Updating poll table now")
-        poll_message = await self.__channel.fetch_message(self.__poll_message_id)
-        poll_data = await self.__generate_poll_data(poll_message)
+        self.__table_update_due = None
+        poll_message = await self.__polls.fetch_poll_message(self.__poll_message_id)
+        poll_data = await self.__polls.generate_poll_data(poll_message)
         self.__log.info(f"Got poll data: {poll_data}")
 
-        table_image = await TableDrawer.default_draw(poll_data)
-        table_image_handle = BytesIO()
-        table_image.save(table_image_handle, 'PNG')
-        table_image_handle.seek(0)
-        table_file = discord.File(table_image_handle, "this_weeks_games.png")
-
-        embed = discord.Embed()
-        message = await self.__dump_channel.send(content=self.poll_image_tag, files=[table_file])
-        image_url = message.attachments[0].url
-        embed.set_image(url=image_url)
-
-        await poll_message.edit(embed=embed)
-        poll_image_messages = [m async for m in
-                self.__dump_channel.history(oldest_first=False) if not
-                m.is_system() and self.poll_image_tag in m.content][1:]
-
-        self.__log.info(f"Found {len(poll_image_messages)} old poll images - deleting")
-
-        for message in poll_image_messages:
-            await message.delete()
-        self.__log.info("Poll table successfully updated")
-
-    async def __generate_poll_data(self, poll_message):
-        thumb_react = discord.utils.get(poll_message.reactions, emoji=self.thumb_up)
-        other_reacts = [r for r in poll_message.reactions if r.emoji not in (self.thumb_up, self.thumb_down)]
-
-        if thumb_react:
-            attendees = [u async for u in thumb_react.users()]
+        # In text mode we only need the image at all if someone might fetch it
+        # from the table server
+        table_png = None
+        if self.__table_mode == "image" or self.__table_server:
+            table_png = await self.__polls.render_table_png(poll_data)
+        if self.__table_server:
+            self.__table_server.publish(table_png, vote_matrix(poll_data))
+
+        # The suggested tables only exist as an image, so text mode goes
+        # without them
+        if self.__table_mode == "text":
+            await self.__polls.publish_text_table(poll_data)
         else:
-            attendees = []
-
-        self.__log.info(f"Found {len(attendees)} attendees, who want to play {len(other_reacts)} games")
-
-        table_data = defaultdict(list)
-        for react in other_reacts:
-            react_users = [u async for u in react.users()]
-            for user in react_users:
-                table_data[user].append(react)
-
-        non_voters = set(attendees) - set(table_data.keys())
-        for non_voter in non_voters:
-            table_data[non_voter] = []
-
-        return table_data
-
-    def __generate_poll_message_body(self, last_date, next_date):
-        with open(self.poll_message_file, 'r') as f:
-            content = f.read()
-        messages = ruamel.yaml.load(content, Loader=ruamel.yaml.RoundTripLoader)
-
-        def parse_scheduled_message(message_struct):
-            dt = dateparser.parse(message_struct["when"])
-            return {"when": dt, "message": message_struct["message"]}
-
-        scheduled_messages = messages["scheduled_messages"]
+            assignment = await self.__polls.solve_tables(poll_data)
+            assignment_png = await self.__polls.render_assignment_png(assignment) if assignment else None
+            await self.__polls.publish_table_image(poll_message, table_png, assignment_png)
+        self.__published_fingerprint = poll_fingerprint(poll_data)
+        self.__log.info("Poll table successfully updated")
 
-        for msg_index, scheduled_message in enumerate(scheduled_messages):
-            when = dateparser.parse(scheduled_message["when"])
-            if last_date < when < next_date:
-                message = scheduled_message["message"]
-                del messages["scheduled_messages"][msg_index]
-                return (message, messages)
+    def __set_reset_timer(self, next_poll_datetime=None):
+        if next_poll_datetime is None:
+            next_poll_datetime = self.__next_poll_datetime()
 
-        if len(messages["random_messages"]) > 0:
-            random_msg_index = random.randint(0, len(messages["random_messages"]))
-            message = messages["random_messages"][random_msg_index]
-            del messages["random_messages"][random_msg_index]
-            return message, messages
+        time_until_reset = (next_poll_datetime - datetime.now()).total_seconds()
 
-        return messages["default_message"], messages
+        if self.__reset_timer:
+            self.__reset_timer.cancel()
+        self.__next_reset = next_poll_datetime
+        self.__reset_timer = Timer(time_until_reset, self.__reset_poll, callback_async=True)
+        self.__log.info(f"Set timer to expire at around {next_poll_datetime} - {time_until_reset} seconds from now")
 
-    def __set_reset_timer(self):
+    def __next_poll_datetime(self):
         friday = 4  # python day of week constant meanining Friday
         now = datetime.now()
         today = now.date()
@@ -217,61 +193,117 @@ class LiveBot(commands.Bot):
             self.__log.error(f"Got a negative time until reset. Your logic is wrong somehow! Now is {now}, and I think the next poll should be at {next_poll_datetime} - patching this hole...")
             next_poll_datetime += timedelta(days=7)
 
-        time_until_reset = (next_poll_datetime - datetime.now()).total_seconds()
-
-        self.__reset_timer = Timer(time_until_reset, self.__reset_poll, callback_async=True)
-        self.__log.info(f"Set timer to expire at around {next_poll_datetime} - {time_until_reset} seconds from now")
+        return next_poll_datetime
 
     async def __reset_poll(self):
         self.__log.info("Resetting poll!")
+        self.__reset_timer = None
 
-        await self.__stash_results()
-
-        self.__log.info("Deleting old poll")
-        messages = [m async for m in self.__channel.history(oldest_first=True)
-                if not m.is_system()][1:]
-        for message in messages:
-            await message.delete()
-        self.__poll_message_id = (await self.__create_poll_message()).id
-        self.__log.info(f"Created new poll - message ID {self.__poll_message_id}")
-        self.__set_reset_timer()
+        # Whatever goes wrong, make sure we try again next week rather than
+        # never resetting the poll again
+        try:
+            last_poll_result = await self.__stash_results()
+
+            self.__log.info("Deleting old poll")
+            messages = await self.__polls.find_clearable_messages()
+            await self.__polls.delete_messages(messages)
+            self.__polls.forget_table_messages()
+            self.__poll_message_id = (await self.__polls.create_poll_message(last_poll_result)).id
+            self.__published_fingerprint = None
+            self.__log.info(f"Created new poll - message ID {self.__poll_message_id}")
+        finally:
+            self.__set_reset_timer()
 
     async def __stash_results(self):
         self.__log.info("Stashing poll results")
-        poll_message = await self.__channel.fetch_message(self.__poll_message_id)
-        poll_data = await self.__generate_poll_data(poll_message)
+        # The results get archived and feed next week's poll message, so don't
+        # trust any cached reaction users for them
+        self.__polls.mark_all_stale()
+        poll_message = await self.__polls.fetch_poll_message(self.__poll_message_id)
+        poll_data = await self.__polls.generate_poll_data(poll_message)
 
         self.__log.info("Logging this poll data:")
         self.__log.info(pformat(poll_data))
-        jsonable_poll = {
-            "date": datetime.now().strftime("%Y-%m-%d"),
-            "poll_results": [
-                {
-                    "user_id": user.id,
-                    "votes": [v.emoji.name if v.is_custom_emoji() else v.emoji for v in votes],
-                }
-                for (user, votes) in poll_data.items()
-            ]
-        }
-        self.__log.info("Logging this data:")
-        self.__log.info(str(jsonable_poll))
-        json_data = json.dumps(jsonable_poll)
-
-        await self.__dump_channel.send(content="\n".join([self.poll_result_tag, json_data]))
+        return await self.__polls.stash_results(poll_data)
+
+    def __image_cache_dir(self):
+        return os.path.splitext(self.__state_file)[0] + "_images"
+
+    def __save_snapshot(self):
+        if not self.__state_file or self.__polls is None:
+            return
+
+        # The snapshot goes first - we may not get long to shut down, and it's far
+        # more use than the images, which load_cache copes with going missing
+        try:
+            image_cache = self.__table_drawer.cache_index()
+            snapshot = BotSnapshot(
+                poll_message_id=self.__poll_message_id,
+                reactions=self.__polls.export_reactions(),
+                table_fingerprint=self.__published_fingerprint,
+                next_reset=self.__next_reset,
+                table_update_due=self.__table_update_due,
+                verified_role_id=self.__verified_role_id,
+                image_cache=image_cache,
+            )
+            snapshot.save(self.__state_file)
+            self.__log.info(f"Saved state snapshot to {self.__state_file}")
+        except Exception as e:
+            self.__log.error("Failed to save state snapshot - next startup will be a cold one")
+            self.__log.exception(e)
+            return
+
+        try:
+            self.__table_drawer.save_cache(self.__image_cache_dir(), image_cache)
+        except Exception as e:
+            self.__log.error("Failed to save cached images - they'll be downloaded again")
+            self.__log.exception(e)
+
+    async def __restore_poll_message(self, snapshot):
+        if not snapshot or not snapshot.poll_message_id:
+            return None
+
+        try:
+            poll_message = await self.__polls.fetch_poll_message(snapshot.poll_message_id)
+        except discord.NotFound:
+            self.__log.info(f"Poll message {snapshot.poll_message_id} from the snapshot is gone - rescanning")
+            return None
+
+        if snapshot.reactions.get("message_id") == poll_message.id:
+            self.__polls.restore_reactions(snapshot.reactions, self._connection.store_user)
+            self.__published_fingerprint = snapshot.table_fingerprint
+        self.__table_drawer.load_cache(self.__image_cache_dir(), snapshot.image_cache)
+        self.__log.info(f"Restored poll message {poll_message.id} from the snapshot")
+        return poll_message
 
     async def on_ready(self):
         self.__log.info("Connected!")
-        self.__poll_message_id = None
+        if self.__started:
+            # discord.py fires on_ready again after reconnecting, but all our
+            # state and timers survive that, so there's nothing to redo
+            self.__log.info("Reconnected - carrying on where we were")
+            return
+        self.__started = True
+
         self.__guild = self.get_guild(self.__guild_id)
         channels = self.__guild.channels
         self.__channel = next(c for c in channels if c.name == self.__channel_name)
         self.__dump_channel = next(c for c in channels if c.name == self.__dump_channel_name)
         self.__log.info(f"Running in guild {self.__guild}, channel {self.__channel}, dump channel {self.__dump_channel}")
-        poll_message = await self.__find_poll_message()
+        self.__polls = PollService(self.__channel, self.__dump_channel, self.user,
+                                   role_id=self.__role_id, message_queue=self.__message_queue,
+                                   scheduler=self.__scheduler, table_drawer=self.__table_drawer,
+                                   table_solver=self.__table_solver)
+
+        snapshot = BotSnapshot.load(self.__state_file) if self.__state_file else None
+        poll_message = await self.__restore_poll_message(snapshot)
+        warm_start = poll_message is not None
+        if not warm_start:
+            poll_message = await self.__polls.find_poll_message()
 
         if not poll_message:
             self.__log.info("Didn't find a poll message on startup, posting a new one")
-            self.__poll_message_id = (await self.__create_poll_message()).id
+            self.__poll_message_id = (await self.__polls.create_poll_message()).id
         elif datetime.now(pytz.utc) - poll_message.created_at > timedelta(days=7):
             self.__poll_message_id = poll_message.id
             self.__log.info("Found a poll message on startup, but it is more than 7 days old - resetting")
@@ -286,11 +318,15 @@ class LiveBot(commands.Bot):
 
         if self.__role_id == 0:
             self.__log.info("No role ID set, will ping @everyone")
+        elif warm_start and snapshot.verified_role_id == self.__role_id:
+            self.__log.info(f"Will notify role ID {self.__role_id}, which was already checked before the restart")
+            self.__verified_role_id = self.__role_id
         else:
             roles = await self.__guild.fetch_roles()
             target_role = next((r for r in roles if r.id == self.__role_id), None)
             if target_role:
                 self.__log.info(f"Will notify role @{target_role.name}")
+                self.__verified_role_id = self.__role_id
             else:
                 self.__log.critical(f"You've asked me to notify role ID {self.__role_id}, but I couldn't find any such role in this guild")
                 self.__log.critical("I found the following roles:")
@@ -298,4 +334,38 @@ class LiveBot(commands.Bot):
                     self.__log.critical(f"{role.id}: {role.name}")
                 raise RuntimeError("Could not find role")
 
-        self.__set_reset_timer()
+        if self.__reset_timer is None:
+            if warm_start and snapshot.next_reset and snapshot.next_reset > datetime.now():
+                self.__set_reset_timer(snapshot.next_reset)
+            else:
+                self.__set_reset_timer()
+
+        if warm_start and self.__poll_message_id == poll_message.id:
+            await self.__reconcile(poll_message, snapshot)
+        elif self.__table_server and self.__table_server.table_etag is None:
+            self.__log.info("Drawing the poll table so the table server has something to serve")
+            self.__schedule_table_update()
+
+    # Works out whether anyone reacted while we were down. Reactions whose
+    # counts haven't moved are taken from the snapshot, so this is usually just
+    # the one fetch of the poll message we've already made. That means it can't
+    # see one person swapping a reaction for another while we were down - the
+    # count stays the same - so the table can be out of date until that
+    # reaction next changes. Stashed results always refetch everything, so
+    # they're never affected.
+    async def __reconcile(self, poll_message, snapshot):
+        poll_data = await self.__polls.generate_poll_data(poll_message)
+        fingerprint = poll_fingerprint(poll_data)
+
+        if fingerprint != self.__published_fingerprint:
+            self.__log.info("Votes changed while we were away - redrawing the poll table")
+            self.__schedule_table_update()
+        elif snapshot.table_update_due is not None:
+            delay = max(0, (snapshot.table_update_due - datetime.now()).total_seconds())
+            self.__log.info(f"A table update was pending before the restart - running it in {delay} seconds")
+            self.__schedule_table_update(delay)
+        elif self.__table_server and self.__table_server.table_etag is None:
+            self.__log.info("Drawing the poll table so the table server has something to serve")
+            self.__schedule_table_update()
+        else:
+            self.__log.info("Poll table is already up to date")
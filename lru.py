@@ -0,0 +1,26 @@
+from collections import OrderedDict
+
+
+# A dict which forgets its least recently used entries once it holds more than
+# maxsize of them. With maxsize=None it never forgets anything.
+class LRUCache(OrderedDict):
+    def __init__(self, maxsize=None):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
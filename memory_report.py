@@ -0,0 +1,27 @@
+import asyncio
+import resource
+import sys
+
+
+def current_rss():
+    # /proc gives us the current figure, where getrusage only knows the peak
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports this in kilobytes, macOS in bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+async def report_rss(log, interval):
+    baseline = current_rss()
+    log.info(f"RSS at startup: {baseline / 2**20:.1f} MiB")
+    while True:
+        await asyncio.sleep(interval)
+        rss = current_rss()
+        log.info(f"RSS: {rss / 2**20:.1f} MiB ({(rss - baseline) / 2**20:+.1f} MiB since startup)")
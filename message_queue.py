@@ -0,0 +1,149 @@
+import bisect
+import json
+import logging
+import random
+from datetime import datetime
+
+import dateparser
+import ruamel.yaml
+
+from poll_templates import compile_or_literal, PollTemplate
+
+
+class QueuedMessage:
+    SCHEDULED = "scheduled"
+    RANDOM = "random"
+    DEFAULT = "default"
+
+    def __init__(self, kind, text, template, index=None):
+        self.kind = kind
+        self.text = text
+        self.template = template
+        self.index = index
+
+    def render(self, context):
+        return self.template.render_or(PollTemplate.literal(self.text), context)
+
+    def __repr__(self):
+        return f"QueuedMessage({self.kind!r}, {self.text!r})"
+
+
+# The YAML file is only read once, at construction time, and every message in it
+# is compiled into a template straight away. Every message handed out gets
+# appended to a consumption log, which is replayed on load so that used messages
+# stay used across restarts without ever rewriting the YAML.
+class MessageQueue:
+    def __init__(self, message_file, log_file=None):
+        self.__message_file = message_file
+        self.__log_file = log_file or f"{message_file}.log"
+        self.__log = logging.getLogger(f"ocb.{__name__}")
+
+        with open(message_file, 'r') as f:
+            content = ruamel.yaml.safe_load(f)
+
+        scheduled = []
+        for scheduled_message in content.get("scheduled_messages") or []:
+            when = dateparser.parse(scheduled_message["when"])
+            if when is None:
+                self.__log.error(f"Could not parse {scheduled_message['when']!r} as a date - ignoring this scheduled message")
+                continue
+            scheduled.append((when, scheduled_message["message"]))
+        scheduled.sort(key=lambda s: s[0])
+
+        self.__scheduled_whens = [when for when, _ in scheduled]
+        self.__scheduled_messages = [message for _, message in scheduled]
+        self.__random_messages = list(content.get("random_messages") or [])
+        self.__default_message = content.get("default_message", "")
+        self.__templates = {
+            message: compile_or_literal(message)
+            for message in self.__scheduled_messages + self.__random_messages + [self.__default_message]
+        }
+
+        self.__replay_log()
+        self.__log.info(f"Loaded {len(self.__scheduled_messages)} scheduled and {len(self.__random_messages)} random messages from {message_file}")
+
+    def __replay_log(self):
+        try:
+            with open(self.__log_file, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                self.__log.warning(f"Skipping corrupt line in {self.__log_file}: {line!r}")
+                continue
+
+            if entry["kind"] == QueuedMessage.SCHEDULED:
+                when = datetime.fromisoformat(entry["when"]) if entry.get("when") else None
+                self.__remove_scheduled(entry["message"], when=when)
+            elif entry["kind"] == QueuedMessage.RANDOM:
+                self.__remove_random(entry["message"])
+
+    # Messages are removed by the index peek handed out with them, so that two
+    # with the same text can't be mixed up. Only the log replay, which has no
+    # index to go on, falls back to looking them up by date and text.
+    def __remove_scheduled(self, text, index=None, when=None):
+        if index is None or index >= len(self.__scheduled_messages) or self.__scheduled_messages[index] != text:
+            candidates = [i for i, message in enumerate(self.__scheduled_messages) if message == text]
+            if when is not None:
+                candidates = [i for i in candidates if self.__scheduled_whens[i] == when] or candidates
+            if not candidates:
+                return None
+            index = candidates[0]
+        del self.__scheduled_messages[index]
+        return self.__scheduled_whens.pop(index)
+
+    def __remove_random(self, text, index=None):
+        if index is None or index >= len(self.__random_messages) or self.__random_messages[index] != text:
+            try:
+                index = self.__random_messages.index(text)
+            except ValueError:
+                return
+
+        # Order doesn't matter for random messages, so swap with the last one
+        # and pop rather than shuffling the whole list down
+        self.__random_messages[index] = self.__random_messages[-1]
+        self.__random_messages.pop()
+
+    # Doesn't consume anything - call consume() once the message has been sent
+    def peek(self, last_date, next_date):
+        start = bisect.bisect_right(self.__scheduled_whens, last_date)
+        if start < len(self.__scheduled_whens) and self.__scheduled_whens[start] < next_date:
+            return self.__queued(QueuedMessage.SCHEDULED, self.__scheduled_messages[start], start)
+
+        if self.__random_messages:
+            index = random.randrange(len(self.__random_messages))
+            return self.__queued(QueuedMessage.RANDOM, self.__random_messages[index], index)
+
+        return self.__queued(QueuedMessage.DEFAULT, self.__default_message)
+
+    def __queued(self, kind, text, index=None):
+        return QueuedMessage(kind, text, self.__templates[text], index)
+
+    def consume(self, message):
+        if message.kind == QueuedMessage.DEFAULT:
+            return
+
+        entry = {
+            "date": datetime.now().isoformat(),
+            "kind": message.kind,
+            "message": message.text,
+        }
+        if message.kind == QueuedMessage.SCHEDULED:
+            when = self.__remove_scheduled(message.text, message.index)
+            if when is not None:
+                entry["when"] = when.isoformat()
+        else:
+            self.__remove_random(message.text, message.index)
+        try:
+            with open(self.__log_file, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+        except Exception as e:
+            self.__log.error(f"Couldn't append to {self.__log_file} - this message may be reused after a restart")
+            self.__log.exception(e)
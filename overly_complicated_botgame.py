@@ -1,15 +1,11 @@
 import discord
 import ruamel.yaml
 import asyncio
-import parsedatetime
-import dateparser
-import random
 from argparse import ArgumentParser
 from texttable import Texttable
-from collections import defaultdict
-from table_drawer import TableDrawer
-from io import BytesIO
 from PIL import Image
+from poll_service import PollService, react_name
+from table_solver import TableSolver
 
 with open("config.yaml", 'r') as f:
     config = ruamel.yaml.safe_load(f)
@@ -17,21 +13,10 @@ with open("config.yaml", 'r') as f:
 TOKEN = config['token']
 GUILD_ID = config['guild_id']
 CHANNEL_NAME = config['channel_name']
-CLIENT = discord.Client()
-POLL_TABLE_MARKER = "{polltable}"
+DUMP_CHANNEL_NAME = config.get('dump_channel_name', "dump-channel")
+ROLE_ID = config.get('role_id', 0)
+GAME_SIZES_FILE = config.get('game_sizes_file', "game_sizes.yaml")
 CHECK = "✅"
-THUMB_UP = "👍"
-THUMB_DOWN = "👎"
-NEXT_GAME_DATE_STR = "next thursday"
-LAST_GAME_DATE_STR = "last thursday"
-POLL_MESSAGE_FILE = "poll_messages.yaml"
-
-
-def get_react_name(react):
-    if react.custom_emoji:
-        return react.emoji.name
-    else:
-        return react.emoji
 
 
 def print_in_box(text):
@@ -65,40 +50,13 @@ def ask_user_to_select_message(messages):
         print("Invalid input")
 
 
-def generate_poll_message_body(last_date, next_date):
-    with open(POLL_MESSAGE_FILE, 'r') as f:
-        content = f.read()
-    messages = ruamel.yaml.load(content, Loader=ruamel.yaml.RoundTripLoader)
-
-    def parse_scheduled_message(message_struct):
-        dt = dateparser.parse(message_struct["when"])
-        return {"when": dt, "message": message_struct["message"]}
-
-    scheduled_messages = messages["scheduled_messages"]
-
-    for msg_index, scheduled_message in enumerate(scheduled_messages):
-        when = dateparser.parse(scheduled_message["when"])
-        if last_date < when < next_date:
-            message = scheduled_message["message"]
-            del messages["scheduled_messages"][msg_index]
-            return (message, messages)
-
-    if messages["random_messages"]:
-        random_msg_index = random.randint(0, len(messages["random_messages"]))
-        message = messages["random_messages"][random_msg_index]
-        del messages["random_messages"][random_msg_index]
-        return message, messages
-
-    return messages["default_message"], messages
-
-
 async def generate_text_table(table_data, check_mark=CHECK):
     games = set()
     users = list(table_data.keys())
     for reacts in table_data.values():
         games |= set(reacts)
     games = list(games)
-    games.sort(key=get_react_name)
+    games.sort(key=react_name)
     users.sort(key=lambda x: x.name)
 
     table = Texttable()
@@ -107,116 +65,138 @@ async def generate_text_table(table_data, check_mark=CHECK):
 
     table.add_row([""] + [a.name for a in users])
     for game in games:
-        game_name = get_react_name(game)
+        game_name = react_name(game)
         table.add_row([":" + game_name + ":"] + [check_mark if game in table_data[attendee] else "" for attendee in users])
 
     return table.draw()
 
 
-async def find_poll_message(messages):
-    everyone_messages = await messages.filter(lambda m: m.mention_everyone).flatten()
-
-    if len(everyone_messages) == 1:
-        return everyone_messages[0]
-    elif len(everyone_messages) == 0:
-        raise RuntimeError("Could not find any valid poll message. Did you remember to @everyone?")
-    else:
-        print("There are several messages which @everyone - which one is the poll message?")
-        return ask_user_to_select_message(everyone_messages)
-
-
-async def generate_poll_data(channel, check_mark=CHECK):
-    messages = channel.history(oldest_first=True)
-
-    poll_message = await find_poll_message(messages)
-
-    print("Reading reactions from this message:")
-    print_in_box(poll_message.content)
-    print()
-
-    thumb_react = discord.utils.get(poll_message.reactions, emoji=THUMB_UP)
-    other_reacts = [r for r in poll_message.reactions if r.emoji not in (THUMB_UP, THUMB_DOWN)]
-
-    attendees = await thumb_react.users().flatten()
-
-    table_data = defaultdict(list)
-    for react in other_reacts:
-        react_users = await react.users().flatten()
-        for user in react_users:
-            table_data[user].append(react)
-
-    non_voters = set(attendees) - set(table_data.keys())
-    for non_voter in non_voters:
-        table_data[non_voter] = []
-
-    return table_data
-
-
-async def find_table_message(channel):
-    return await channel.history().filter(lambda m: m.author == CLIENT.user and m.content.startswith(POLL_TABLE_MARKER)).flatten()
-
-
-async def draw_poll_table(channel):
-    table_data = await generate_poll_data(channel)
-    table_image = await TableDrawer.default_draw(table_data)
-    table_message = await find_table_message(channel)
-    table_image_handle = BytesIO()
-    table_image.save(table_image_handle, 'PNG')
-    table_image_handle.seek(0)
-    guild = discord.utils.get(CLIENT.guilds, id=GUILD_ID)
-    dump_channel = discord.utils.get(guild.channels, name="dump-channel")
-    table_file = discord.File(table_image_handle, "this_weeks_games.png")
-
-    embed = discord.Embed()
-    message = await dump_channel.send(files=[table_file])
-    image_url = message.attachments[0].url
-    embed.set_image(url=image_url)
-
-    if table_message:
-        print("Updating old poll message")
-        await table_message[0].edit(embed=embed)
-        dump_messages = (await dump_channel.history(oldest_first=True).filter(lambda m: not m.is_system()).flatten())[:-1]
-        for message in dump_messages:
-            await message.delete()
-    else:
-        print("Posting new poll message")
-        await channel.send(POLL_TABLE_MARKER, embed=embed)
+# Shared state for one run of the CLI, so that a pipeline of actions only walks
+# the channel history and reads the poll's reactions once between them
+class AdminSession:
+    def __init__(self, polls, assume_yes=False):
+        self.polls = polls
+        self.assume_yes = assume_yes
+        self.__history = None
+        self.__poll_message = None
+        self.__poll_data = None
+
+    async def history(self):
+        if self.__history is None:
+            self.__history = await self.polls.fetch_history()
+        return self.__history
+
+    def remember_message(self, message):
+        if self.__history is not None:
+            self.__history.append(message)
+
+    def forget_messages(self, messages):
+        ids = {m.id for m in messages}
+        if self.__history is not None:
+            self.__history = [m for m in self.__history if m.id not in ids]
+        if self.__poll_message is not None and self.__poll_message.id in ids:
+            self.__poll_message = None
+            self.__poll_data = None
+
+    def set_poll_message(self, message):
+        self.remember_message(message)
+        self.__poll_message = message
+        self.__poll_data = None
+
+    async def poll_message(self):
+        if self.__poll_message is None:
+            self.__poll_message = await self.__find_poll_message()
+        return self.__poll_message
+
+    async def __find_poll_message(self):
+        poll_messages = await self.polls.find_poll_messages(await self.history())
+
+        if len(poll_messages) == 1:
+            return poll_messages[0]
+        elif len(poll_messages) == 0:
+            raise RuntimeError(f"Could not find any valid poll message. Did you remember to include {self.polls.poll_tag}?")
+        else:
+            print("There are several poll messages - which one is the real one?")
+            return ask_user_to_select_message(poll_messages)
+
+    async def poll_data(self):
+        if self.__poll_data is None:
+            poll_message = await self.poll_message()
+
+            print("Reading reactions from this message:")
+            print_in_box(poll_message.content)
+            print()
+
+            self.__poll_data = await self.polls.generate_poll_data(poll_message)
+        return self.__poll_data
+
+
+async def draw_poll_table(session):
+    poll_message = await session.poll_message()
+    table_data = await session.poll_data()
+    table_png = await session.polls.render_table_png(table_data)
+    print("Updating the poll message's table")
+    await session.polls.publish_table_image(poll_message, table_png)
     print("Done! Have a nice day 😊")
 
 
-async def preview_poll_table(channel):
-    table_data = await generate_poll_data(channel)
-    table_image = await TableDrawer.default_draw(table_data)
+async def preview_poll_table(session):
+    table_data = await session.poll_data()
+    table_image = await session.polls.draw_table_image(table_data)
     alpha = table_image.getchannel("A")
     bg = Image.new("RGBA", table_image.size, (0, 0, 0, 255))
     bg.paste(table_image, mask=alpha)
     bg.show()
 
 
-async def print_poll_table(channel):
-    table_data = await generate_poll_data(channel)
+async def print_poll_table(session):
+    table_data = await session.poll_data()
     print("Here's how it breaks down:")
     print(await generate_text_table(table_data))
 
 
-async def post_poll_table(channel):
-    table_data = await generate_poll_data(channel, check_mark="✔")
-    table = await generate_text_table(table_data)
+async def post_poll_table(session):
+    table_data = await session.poll_data()
+    history = await session.history()
 
-    table_message = find_table_message(channel)
+    old_messages = await session.polls.find_table_messages(history)
+    print(f"Updating {len(old_messages)} old poll table messages")
+    table_messages = await session.polls.publish_text_table(table_data, history)
 
-    table_text = POLL_TABLE_MARKER + "\n```\n" + table + "\n```"
-    if table_message:
-        print("Updating old poll message")
-        await table_message[0].edit(content=table_text)
-    else:
-        print("Posting new poll message")
-        await channel.send(table_text)
+    session.forget_messages(old_messages)
+    for message in table_messages:
+        session.remember_message(message)
+    print(f"Poll table is {len(table_messages)} messages long")
     print("Done! Have a nice day 😊")
 
 
-async def clear_messages(channel):
-    messages = (await channel.history(oldest_first=True).filter(lambda m: not m.is_system()).flatten())[1:]
+# Only loaded by the actions that need it, so a missing or broken game sizes
+# file can't stop us posting or clearing polls
+def load_table_solver():
+    try:
+        return TableSolver.from_file(GAME_SIZES_FILE)
+    except FileNotFoundError:
+        print(f"Couldn't find {GAME_SIZES_FILE} - using the default game sizes")
+        return TableSolver()
+
+
+async def solve_poll_tables(session):
+    table_data = await session.poll_data()
+    assignment = await session.polls.solve_tables(table_data, load_table_solver())
+
+    table = Texttable()
+    table.set_max_width(10000)
+    for game, users in sorted(assignment.groups.items(), key=lambda item: -len(item[1])):
+        table.add_row([":" + react_name(game) + ":", ", ".join(u.name for u in users)])
+    if assignment.unassigned:
+        table.add_row(["(nothing)", ", ".join(u.name for u in assignment.unassigned)])
+
+    print(f"Here's my suggestion - {assignment.satisfied} of {len(table_data.attendees)} attendees get to play something they voted for:")
+    print(table.draw())
+
+
+async def clear_messages(session):
+    messages = await session.polls.find_clearable_messages(await session.history())
     if not messages:
         print("There are no messages for me to delete")
         return
@@ -225,77 +205,111 @@ async def clear_messages(channel):
     pretty_print_messages(messages)
     print()
     confirmation_str = "Yes please"
-    print("Are you absolutely sure that these are the messages you want to delete?")
-    print(f"Input \"{confirmation_str}\" - case sensitive - to confirm")
-    in_str = input("> ")
+    if session.assume_yes:
+        print("Skipping confirmation, since you passed --yes")
+        in_str = confirmation_str
+    else:
+        print("Are you absolutely sure that these are the messages you want to delete?")
+        print(f"Input \"{confirmation_str}\" - case sensitive - to confirm")
+        in_str = input("> ")
     if in_str == confirmation_str:
         print("OK, deleting")
         for message in messages:
             await message.delete()
+        session.forget_messages(messages)
         print("Done! Have a nice day 😊")
     else:
         print("Confirmation failed - not deleting")
 
 
-async def post_poll_message(channel):
-    cal = parsedatetime.Calendar()
+async def post_poll_message(session):
+    session.set_poll_message(await session.polls.create_poll_message())
+    print("Done! Have a nice day 😊")
+
+
+ACTION_TABLE = {
+    "print_table": print_poll_table,
+    "clear_messages": clear_messages,
+    "post_table": post_poll_table,
+    "draw_table": draw_poll_table,
+    "preview_table": preview_poll_table,
+    "post_poll_message": post_poll_message,
+    "solve_tables": solve_poll_tables,
+}
 
-    last_datetime, ret = cal.parseDT(LAST_GAME_DATE_STR)
-    if not ret:
-        raise RuntimeError(f"Could not parse {LAST_GAME_DATE_STR} as a datetime")
 
-    next_datetime, ret = cal.parseDT(NEXT_GAME_DATE_STR)
-    if not ret:
-        raise RuntimeError(f"Could not parse {NEXT_GAME_DATE_STR} as a datetime")
+async def run_actions(client, channels, actions, assume_yes):
+    channel = discord.utils.get(channels, name=CHANNEL_NAME)
+    if not channel:
+        print("Error: could not find the configured channel - check config.yaml!")
+        return
+
+    dump_channel = discord.utils.get(channels, name=DUMP_CHANNEL_NAME)
+    if not dump_channel:
+        print("Error: could not find the configured dump channel - check config.yaml!")
+        return
 
-    message_header = "{poll} @everyone"
-    message_body, new_messages_content = generate_poll_message_body(last_datetime, next_datetime)
-    message_footer = f"**Games? {next_datetime.strftime('%d/%m/%Y')}**"
+    polls = PollService(channel, dump_channel, client.user, role_id=ROLE_ID)
+    session = AdminSession(polls, assume_yes=assume_yes)
+    for action in actions:
+        await ACTION_TABLE[action](session)
 
-    message = "\n".join([message_header, message_body, "", message_footer])
 
-    await channel.send(message)
+# Everything the CLI does is plain REST, so by default we never open a gateway
+# session - logging in just fetches our own user, and discord.py's HTTP client
+# reuses one pooled aiohttp session for every request after that.
+async def run_http_only(actions, assume_yes):
+    client = discord.Client(intents=discord.Intents.none())
+    async with client:
+        await client.login(TOKEN)
+        try:
+            guild = await client.fetch_guild(GUILD_ID)
+        except discord.HTTPException:
+            print("Error: could not find the configured guild - check config.yaml!")
+            return
+        channels = await guild.fetch_channels()
+        await run_actions(client, channels, actions, assume_yes)
 
-    with open(POLL_MESSAGE_FILE, 'w') as f:
-        f.write(ruamel.yaml.dump(new_messages_content, Dumper=ruamel.yaml.RoundTripDumper))
 
+def run_with_gateway(actions, assume_yes):
+    intents = discord.Intents.default()
+    intents.message_content = True
+    client = discord.Client(intents=intents)
 
-async def run_bot():
-    parser = ArgumentParser(description="Do some basic admin in the OCB discord channel")
+    @client.event
+    async def on_ready():
+        try:
+            guild = discord.utils.get(client.guilds, id=GUILD_ID)
+            if not guild:
+                print("Error: could not find the configured guild - check config.yaml!")
+                return
+            await run_actions(client, guild.channels, actions, assume_yes)
+        finally:
+            await client.close()
 
-    action_table = {
-        "print_table": print_poll_table,
-        "clear_messages": clear_messages,
-        "post_table": post_poll_table,
-        "draw_table": draw_poll_table,
-        "preview_table": preview_poll_table,
-        "post_poll_message": post_poll_message,
-    }
+    client.run(TOKEN)
 
-    parser.add_argument('action', help=f"The action to perform - one of {action_table.keys()}")
+
+def main():
+    parser = ArgumentParser(description="Do some basic admin in the OCB discord channel")
+    parser.add_argument('actions', metavar='action', nargs='+',
+                        help=f"The actions to perform, in order - any of {', '.join(ACTION_TABLE.keys())}")
+    parser.add_argument('--gateway', action='store_true',
+                        help="Connect a full gateway session rather than just making REST calls")
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help="Don't ask for confirmation before deleting messages")
     args = parser.parse_args()
-    guild = discord.utils.get(CLIENT.guilds, id=GUILD_ID)
-    if not guild:
-        print("Error: could not find the configured guild - check config.yaml!")
 
-    channel = discord.utils.get(guild.channels, name=CHANNEL_NAME)
-    if not channel:
-        print("Error: could not find the configured channel - check config.yaml!")
+    invalid_actions = [a for a in args.actions if a not in ACTION_TABLE]
+    if invalid_actions:
+        print(f"Invalid action - I don't know how to {', '.join(invalid_actions)}")
+        return
 
-    action_func = action_table.get(args.action)
-    if action_func is not None:
-        await action_func(channel)
+    if args.gateway:
+        run_with_gateway(args.actions, args.yes)
     else:
-        print(f"Invalid action - I don't know how to {args.action}")
-
+        asyncio.run(run_http_only(args.actions, args.yes))
 
-@CLIENT.event
-async def on_ready():
-    try:
-        await run_bot()
-    finally:
-        await CLIENT.close()
 
-loop = asyncio.get_event_loop()
-loop.set_exception_handler(lambda *x: None)
-CLIENT.run(TOKEN)
+if __name__ == '__main__':
+    main()
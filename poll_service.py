@@ -0,0 +1,408 @@
+import asyncio
+import functools
+import hashlib
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+from io import BytesIO
+
+import discord
+import parsedatetime
+
+from message_queue import MessageQueue
+from poll_templates import compile_template, build_context
+from request_scheduler import RequestScheduler
+from table_drawer import TableDrawer
+from text_table import ChunkedTextTable
+
+
+def react_name(react):
+    if react.is_custom_emoji():
+        return react.emoji.name
+    else:
+        return react.emoji
+
+
+def reaction_key(emoji):
+    return str(emoji)
+
+
+def user_payload(user):
+    return {
+        "id": str(user.id),
+        "username": user.name,
+        "discriminator": user.discriminator,
+        "avatar": user.avatar.key if user.avatar else None,
+    }
+
+
+# Who voted for what, keyed by user, as built by generate_poll_data. Anyone who
+# reacted at all gets a key, but only those who thumbed-up are attending.
+class PollData(dict):
+    def __init__(self, votes=(), attendees=()):
+        super().__init__(votes)
+        self.attendees = set(attendees)
+
+    def attending_votes(self):
+        return {user: votes for user, votes in self.items() if user in self.attendees}
+
+
+def poll_fingerprint(poll_data):
+    votes = sorted((user.id, user in poll_data.attendees, sorted(reaction_key(r.emoji) for r in reacts))
+                   for user, reacts in poll_data.items())
+    return hashlib.sha1(json.dumps(votes).encode("utf-8")).hexdigest()
+
+
+def vote_matrix(poll_data):
+    games = sorted({react_name(r) for reacts in poll_data.values() for r in reacts})
+    return {
+        "games": games,
+        "users": [
+            {
+                "id": user.id,
+                "name": user.name,
+                "avatar_url": user.display_avatar.url,
+                "votes": [react_name(r) for r in votes],
+            }
+            for user, votes in sorted(poll_data.items(), key=lambda item: item[0].name)
+        ],
+    }
+
+
+# Everything needed to run the weekly poll, independent of how we're connected
+# to Discord. LiveBot drives this from gateway events, while the admin CLI
+# drives it from the command line - possibly over plain REST with no gateway
+# session at all, so nothing in here may rely on the client's caches.
+#
+# Given a RequestScheduler, API calls are prioritised through it and deletions
+# are batched up in the background. Without one, everything is just awaited in
+# order, which is what the CLI wants since it exits as soon as it's done.
+#
+# Who reacted with what is remembered between calls to generate_poll_data, and
+# a reaction's users are only refetched if its count has changed or it has been
+# marked stale - LiveBot marks reactions stale as it sees gateway events for
+# them, so the count check only really matters for changes we didn't see.
+class PollService:
+    poll_tag = "{poll}"
+    poll_image_tag = "{poll_image}"
+    poll_result_tag = "{poll_result}"
+    poll_table_tag = "{polltable}"
+    last_game_date_str = "last thursday"
+    next_game_date_str = "next thursday"
+    thumb_up = "👍"
+    thumb_down = "👎"
+    poll_message_file = "poll_messages.yaml"
+    table_image_filename = "this_weeks_games.png"
+    assignment_image_filename = "suggested_tables.png"
+    default_header_template = compile_template("{poll_tag} {mention}")
+    default_footer_template = compile_template("**Games? {next_game_date:%d/%m/%Y}**")
+    poll_header_template = default_header_template
+    poll_footer_template = default_footer_template
+
+    def __init__(self, channel, dump_channel, me, role_id=0, message_queue=None, scheduler=None, table_drawer=None,
+                 table_solver=None):
+        self.channel = channel
+        self.dump_channel = dump_channel
+        self.me = me
+        self.__role_id = role_id
+        self.__message_queue = message_queue
+        self.__scheduler = scheduler
+        self.__table_drawer = table_drawer or TableDrawer()
+        self.__table_solver = table_solver
+        self.__known_message_id = None
+        self.__known_reactions = {}
+        self.__stale_reactions = set()
+        self.__table_messages = None
+        self.__log = logging.getLogger(f"ocb.{__name__}")
+
+    @property
+    def message_queue(self):
+        # Loaded lazily, since most CLI actions never post a poll
+        if self.__message_queue is None:
+            self.__message_queue = MessageQueue(self.poll_message_file)
+        return self.__message_queue
+
+    async def __request(self, priority, route, func, *args, **kwargs):
+        if self.__scheduler is None:
+            return await func(*args, **kwargs)
+        return await self.__scheduler.submit(priority, route, func, *args, **kwargs)
+
+    @staticmethod
+    async def __collect(iterator):
+        return [x async for x in iterator]
+
+    async def delete_messages(self, messages):
+        if self.__scheduler is None:
+            for message in messages:
+                await message.delete()
+        else:
+            self.__scheduler.defer_delete(messages)
+
+    async def fetch_history(self):
+        return await self.__request(RequestScheduler.FETCH, ("history", self.channel.id),
+                                    self.__collect, self.channel.history(oldest_first=True))
+
+    async def fetch_poll_message(self, message_id):
+        return await self.__request(RequestScheduler.FETCH, ("fetch_message", self.channel.id),
+                                    self.channel.fetch_message, message_id)
+
+    # The finders below take an optional, already-fetched, oldest-first history
+    # so that callers doing several things at once only walk the channel once
+    async def find_poll_messages(self, history=None):
+        if history is None:
+            history = await self.fetch_history()
+        return [m for m in history if self.poll_tag in m.content]
+
+    async def find_poll_message(self, history=None):
+        poll_messages = await self.find_poll_messages(history)
+
+        if len(poll_messages) == 0:
+            return None
+        elif len(poll_messages) > 1:
+            self.__log.warning(f"Found several possible poll messages, will guess at this one: {poll_messages[0]}")
+        return poll_messages[0]
+
+    async def find_table_messages(self, history=None):
+        if history is None:
+            history = await self.fetch_history()
+        return [m for m in history if m.author == self.me and m.content.startswith(self.poll_table_tag)]
+
+    async def find_clearable_messages(self, history=None):
+        if history is None:
+            history = await self.fetch_history()
+        return [m for m in history if not m.is_system()][1:]
+
+    def mark_stale(self, emoji):
+        self.__stale_reactions.add(reaction_key(emoji))
+
+    def mark_all_stale(self):
+        self.__known_reactions = {}
+
+    def export_reactions(self):
+        users = {}
+        reactions = {}
+        for key, (count, react_users) in self.__known_reactions.items():
+            for user in react_users:
+                users[str(user.id)] = user_payload(user)
+            reactions[key] = {"count": count, "user_ids": [str(u.id) for u in react_users]}
+        return {"message_id": self.__known_message_id, "users": users, "reactions": reactions}
+
+    # make_user turns one of user_payload's dicts back into a discord.User
+    def restore_reactions(self, data, make_user):
+        users = {user_id: make_user(payload) for user_id, payload in data["users"].items()}
+        self.__known_message_id = data["message_id"]
+        self.__known_reactions = {
+            key: (reaction["count"], [users[user_id] for user_id in reaction["user_ids"]])
+            for key, reaction in data["reactions"].items()
+        }
+
+    # A reaction whose count hasn't changed is assumed to have the same users.
+    # That's only safe while we're hearing about every reaction event - if one
+    # person removes a reaction and another adds it while nobody's listening,
+    # the count doesn't move and we'd keep the old voters, so anything that
+    # matters more than the live table should mark_all_stale first.
+    async def __reaction_users(self, react, stale):
+        key = reaction_key(react.emoji)
+        known = self.__known_reactions.get(key)
+        if known is not None and known[0] == react.count and key not in stale:
+            return known[1]
+
+        users = await self.__request(RequestScheduler.FETCH, ("reaction_users", react.message.id),
+                                     self.__collect, react.users())
+        self.__known_reactions[key] = (react.count, users)
+        return users
+
+    async def generate_poll_data(self, poll_message):
+        if poll_message.id != self.__known_message_id:
+            self.__known_message_id = poll_message.id
+            self.__known_reactions = {}
+
+        stale, self.__stale_reactions = self.__stale_reactions, set()
+        try:
+            poll_data = await self.__generate_poll_data(poll_message, stale)
+        except BaseException:
+            self.__stale_reactions |= stale
+            raise
+
+        current_keys = {reaction_key(r.emoji) for r in poll_message.reactions}
+        for key in set(self.__known_reactions) - current_keys:
+            del self.__known_reactions[key]
+        return poll_data
+
+    async def __generate_poll_data(self, poll_message, stale):
+        thumb_react = discord.utils.get(poll_message.reactions, emoji=self.thumb_up)
+        other_reacts = [r for r in poll_message.reactions if r.emoji not in (self.thumb_up, self.thumb_down)]
+
+        if thumb_react:
+            attendees = await self.__reaction_users(thumb_react, stale)
+        else:
+            attendees = []
+
+        self.__log.info(f"Found {len(attendees)} attendees, who want to play {len(other_reacts)} games")
+
+        table_data = defaultdict(list)
+        for react in other_reacts:
+            react_users = await self.__reaction_users(react, stale)
+            for user in react_users:
+                table_data[user].append(react)
+
+        non_voters = set(attendees) - set(table_data.keys())
+        for non_voter in non_voters:
+            table_data[non_voter] = []
+
+        return PollData(table_data, attendees)
+
+    async def find_last_poll_result(self):
+        return await self.__request(RequestScheduler.FETCH, ("history", self.dump_channel.id),
+                                    self.__scan_for_last_poll_result)
+
+    async def __scan_for_last_poll_result(self):
+        async for message in self.dump_channel.history(oldest_first=False):
+            if message.content.startswith(self.poll_result_tag):
+                try:
+                    return json.loads(message.content[len(self.poll_result_tag):])
+                except ValueError:
+                    self.__log.warning(f"Couldn't parse stashed poll result in message {message.id}")
+        return None
+
+    async def create_poll_message(self, last_poll_result=None):
+        cal = parsedatetime.Calendar()
+
+        last_datetime, ret = cal.parseDT(self.last_game_date_str)
+        if not ret:
+            raise RuntimeError(f"Could not parse {self.last_game_date_str} as a datetime")
+
+        next_datetime, ret = cal.parseDT(self.next_game_date_str)
+        if not ret:
+            raise RuntimeError(f"Could not parse {self.next_game_date_str} as a datetime")
+
+        if last_poll_result is None:
+            last_poll_result = await self.find_last_poll_result()
+
+        if self.__role_id:
+            mention = f"<@&{self.__role_id}>"
+        else:
+            mention = "@everyone"
+        context = build_context(last_datetime, next_datetime, last_poll_result,
+                                poll_tag=self.poll_tag, mention=mention)
+
+        message_header = self.poll_header_template.render_or(self.default_header_template, context)
+        message_body = self.message_queue.peek(last_datetime, next_datetime)
+        message_footer = self.poll_footer_template.render_or(self.default_footer_template, context)
+
+        message = "\n".join([message_header, message_body.render(context), "", message_footer])
+
+        ret = await self.__request(RequestScheduler.POLL_EDIT, ("send", self.channel.id), self.channel.send, message)
+        self.message_queue.consume(message_body)
+
+        return ret
+
+    async def stash_results(self, poll_data):
+        jsonable_poll = {
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "poll_results": [
+                {
+                    "user_id": user.id,
+                    "attending": user in poll_data.attendees,
+                    "votes": [react_name(v) for v in votes],
+                }
+                for (user, votes) in poll_data.items()
+            ]
+        }
+        self.__log.info("Logging this data:")
+        self.__log.info(str(jsonable_poll))
+        json_data = json.dumps(jsonable_poll)
+
+        await self.__request(RequestScheduler.POLL_EDIT, ("send", self.dump_channel.id),
+                             self.dump_channel.send, content="\n".join([self.poll_result_tag, json_data]))
+        return jsonable_poll
+
+    async def draw_table_image(self, poll_data):
+        return await self.__table_drawer.draw(poll_data)
+
+    @staticmethod
+    def __encode_png(image):
+        image_handle = BytesIO()
+        image.save(image_handle, 'PNG')
+        return image_handle.getvalue()
+
+    async def render_table_png(self, poll_data):
+        return self.__encode_png(await self.draw_table_image(poll_data))
+
+    async def solve_tables(self, poll_data, table_solver=None):
+        table_solver = table_solver or self.__table_solver
+        if table_solver is None:
+            return None
+        # Only people who've thumbed-up are coming, whatever else they voted for.
+        # The solver spends its whole time budget searching, so keep it off the event loop
+        solve = functools.partial(table_solver.solve, poll_data.attending_votes(), game_name=react_name)
+        return await asyncio.get_running_loop().run_in_executor(None, solve)
+
+    async def render_assignment_png(self, assignment):
+        return self.__encode_png(await self.__table_drawer.draw_assignment(assignment))
+
+    async def publish_table_image(self, poll_message, table_png, assignment_png=None):
+        files = [discord.File(BytesIO(table_png), self.table_image_filename)]
+        if assignment_png is not None:
+            files.append(discord.File(BytesIO(assignment_png), self.assignment_image_filename))
+
+        message = await self.__request(RequestScheduler.POLL_EDIT, ("send", self.dump_channel.id),
+                                       self.dump_channel.send, content=self.poll_image_tag, files=files)
+        embeds = []
+        for attachment in message.attachments:
+            embed = discord.Embed()
+            embed.set_image(url=attachment.url)
+            embeds.append(embed)
+
+        await self.__request(RequestScheduler.POLL_EDIT, ("edit", self.channel.id), poll_message.edit, embeds=embeds)
+
+        if self.__scheduler is None:
+            await self.__clean_up_table_images(message)
+        else:
+            # Walking the dump channel doesn't go through the scheduler - only
+            # the deletes it turns up do, at cleanup priority
+            self.__scheduler.run_in_background(self.__clean_up_table_images(message))
+
+    async def __clean_up_table_images(self, latest_image_message):
+        poll_image_messages = [m async for m in self.dump_channel.history(oldest_first=False)
+                               if not m.is_system() and self.poll_image_tag in m.content
+                               and m.id < latest_image_message.id]
+
+        self.__log.info(f"Found {len(poll_image_messages)} old poll images - deleting")
+        await self.delete_messages(poll_image_messages)
+
+    # Only edits the chunks whose text has changed, posts any extra ones, and
+    # deletes any left over from when the table was longer. The table messages
+    # are remembered between calls, so only the first one has to go looking
+    # for them.
+    async def publish_text_table(self, poll_data, history=None):
+        chunks = ChunkedTextTable(self.poll_table_tag, game_name=react_name).chunks(poll_data)
+
+        if self.__table_messages is None or history is not None:
+            self.__table_messages = sorted(await self.find_table_messages(history), key=lambda m: m.id)
+        existing = self.__table_messages
+
+        published = []
+        for index, content in enumerate(chunks):
+            if index < len(existing):
+                message = existing[index]
+                if message.content != content:
+                    message = await self.__request(RequestScheduler.POLL_EDIT, ("edit", self.channel.id),
+                                                   message.edit, content=content)
+            else:
+                message = await self.__request(RequestScheduler.POLL_EDIT, ("send", self.channel.id),
+                                               self.channel.send, content)
+            published.append(message)
+
+        surplus = existing[len(chunks):]
+        self.__table_messages = published
+        await self.delete_messages(surplus)
+
+        self.__log.info(f"Text table is {len(chunks)} messages long - "
+                        f"{sum(1 for old, new in zip(existing, published) if old is not new)} edited, "
+                        f"{max(0, len(chunks) - len(existing))} posted, {len(surplus)} deleted")
+        return published
+
+    def forget_table_messages(self):
+        self.__table_messages = None
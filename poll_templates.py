@@ -0,0 +1,181 @@
+import ast
+import functools
+import logging
+import re
+from collections import Counter
+from datetime import datetime
+from string import Formatter
+
+
+class TemplateError(Exception):
+    pass
+
+
+# Template fields are python expressions, but only a small, side-effect free
+# subset of them. No calls, no comprehensions, no dunder attribute access -
+# just names from the render context and some arithmetic on them.
+_ALLOWED_NODES = (
+    ast.Expression,
+    ast.Name,
+    ast.Load,
+    ast.Attribute,
+    ast.Constant,
+    ast.Subscript,
+    ast.Slice,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.USub,
+    ast.UAdd,
+)
+
+
+# Limits on how much text a single field can produce. Without these, something
+# like {'a' * 999999999} or {attendance:999999999} would happily eat all our
+# memory before we ever got to post it.
+_MAX_FIELD_LENGTH = 2000
+_FORMAT_SPEC_NUMBERS = re.compile(r"\d+")
+
+
+def _safe_mult(left, right):
+    for sequence, count in ((left, right), (right, left)):
+        if isinstance(sequence, (str, bytes, tuple, list)) and isinstance(count, int):
+            if len(sequence) * count > _MAX_FIELD_LENGTH:
+                raise TemplateError(f"Repeating a {type(sequence).__name__} {count} times makes it too long")
+    return left * right
+
+
+def _safe_mod(left, right):
+    if isinstance(left, (str, bytes)):
+        raise TemplateError("%-formatting isn't supported in templates - use a format spec instead")
+    return left % right
+
+
+# Swaps the operators that can build arbitrarily big strings for calls to the
+# checked versions above. Only ever run after the field has been validated, so
+# the private names it introduces can't come from the template itself.
+class _GuardOperators(ast.NodeTransformer):
+    guards = {ast.Mult: "_safe_mult", ast.Mod: "_safe_mod"}
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        guard = self.guards.get(type(node.op))
+        if guard is None:
+            return node
+        return ast.copy_location(ast.Call(func=ast.Name(id=guard, ctx=ast.Load()),
+                                          args=[node.left, node.right], keywords=[]), node)
+
+
+def _check_format_spec(field, format_spec):
+    if "{" in format_spec or "}" in format_spec:
+        raise TemplateError(f"Template field {{{field}}} has a nested field in its format spec")
+    for number in _FORMAT_SPEC_NUMBERS.findall(format_spec):
+        if int(number) > _MAX_FIELD_LENGTH:
+            raise TemplateError(f"Template field {{{field}}} has an oversized format spec {format_spec!r}")
+
+
+def _compile_field(field):
+    try:
+        tree = ast.parse(field.strip(), mode="eval")
+    except SyntaxError as e:
+        raise TemplateError(f"Invalid template field {{{field}}}: {e}") from e
+
+    for node in ast.walk(tree):
+        if not isinstance(node, _ALLOWED_NODES):
+            raise TemplateError(f"Template field {{{field}}} uses a forbidden {type(node).__name__}")
+        if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+            raise TemplateError(f"Template field {{{field}}} accesses private attribute {node.attr}")
+        if isinstance(node, ast.Name) and node.id.startswith("_"):
+            raise TemplateError(f"Template field {{{field}}} references private name {node.id}")
+
+    tree = ast.fix_missing_locations(_GuardOperators().visit(tree))
+    return compile(tree, f"<template field {field}>", "eval")
+
+
+class PollTemplate:
+    def __init__(self, source, parts):
+        self.source = source
+        self.__parts = parts
+
+    @classmethod
+    def literal(cls, source):
+        return cls(source, [source])
+
+    def render(self, context):
+        namespace = {"__builtins__": {}, "_safe_mult": _safe_mult, "_safe_mod": _safe_mod}
+        out = []
+        for part in self.__parts:
+            if isinstance(part, str):
+                out.append(part)
+                continue
+
+            code, conversion, format_spec = part
+            try:
+                value = eval(code, namespace, context)
+                if conversion == "r":
+                    value = repr(value)
+                elif conversion == "s":
+                    value = str(value)
+                out.append(format(value, format_spec))
+            except Exception as e:
+                raise TemplateError(f"Failed to render {self.source!r}: {e}") from e
+        return "".join(out)
+
+    def render_or(self, fallback, context):
+        try:
+            return self.render(context)
+        except TemplateError as e:
+            logging.getLogger(f"ocb.{__name__}").error(f"{e} - using {fallback.source!r} instead")
+            return fallback.render(context)
+
+
+@functools.lru_cache(maxsize=None)
+def compile_template(source):
+    parts = []
+    try:
+        parsed = list(Formatter().parse(source))
+    except ValueError as e:
+        raise TemplateError(f"Invalid template {source!r}: {e}") from e
+
+    for literal, field, format_spec, conversion in parsed:
+        if literal:
+            parts.append(literal)
+        if field is None:
+            continue
+        if conversion not in (None, "r", "s"):
+            raise TemplateError(f"Unsupported conversion !{conversion} in {source!r}")
+        _check_format_spec(field, format_spec or "")
+        parts.append((_compile_field(field), conversion, format_spec or ""))
+
+    return PollTemplate(source, parts)
+
+
+def compile_or_literal(source):
+    try:
+        return compile_template(source)
+    except TemplateError as e:
+        logging.getLogger(f"ocb.{__name__}").error(f"{e} - will post it verbatim")
+        return PollTemplate.literal(source)
+
+
+def build_context(last_game_date, next_game_date, last_poll_result=None, top_game_count=3, **extra):
+    results = (last_poll_result or {}).get("poll_results", [])
+    vote_counts = Counter(vote for result in results for vote in result["votes"])
+    top_games = [game for game, _ in vote_counts.most_common(top_game_count)]
+
+    context = {
+        "now": datetime.now(),
+        "last_game_date": last_game_date,
+        "next_game_date": next_game_date,
+        # Results stashed before we recorded who thumbed-up count everyone
+        "attendance": sum(1 for result in results if result.get("attending", True)),
+        "top_games": ", ".join(top_games),
+        "top_game": top_games[0] if top_games else "",
+    }
+    context.update(extra)
+    return context
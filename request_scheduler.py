@@ -0,0 +1,229 @@
+import asyncio
+import itertools
+import logging
+import time
+from collections import defaultdict
+
+import discord
+
+from aio_timers import Timer
+
+
+class RouteBucket:
+    def __init__(self, capacity, period):
+        self.capacity = capacity
+        self.period = period
+        self.__tokens = capacity
+        self.__last_refill = time.monotonic()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__last_refill) * self.capacity / self.period)
+        self.__last_refill = now
+
+    def delay(self):
+        self.__refill()
+        if self.__tokens >= 1:
+            return 0
+        return (1 - self.__tokens) * self.period / self.capacity
+
+    def take(self):
+        self.__refill()
+        self.__tokens -= 1
+
+    def block_for(self, seconds):
+        self.__refill()
+        self.__tokens = min(self.__tokens, 1 - seconds * self.capacity / self.period)
+
+
+class _Request:
+    def __init__(self, route, func, args, kwargs, future):
+        self.route = route
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+
+
+# Funnels the live bot's Discord API calls through one queue, so that when we're
+# close to a rate limit the things people are actually looking at (the poll
+# message) go first, and housekeeping like deleting old table images waits.
+# Each request runs in its own task once started, so a slow fetch never holds
+# up a poll edit behind it. Cleanup requests are the exception - they aren't
+# started at all while any poll edit or fetch is still in flight, so they never
+# compete with the work someone is waiting on.
+#
+# Routes are arbitrary hashable keys, by convention (action, channel_id). The
+# buckets here are purely local throttles on how fast we start requests for a
+# route - they're guesses, and know nothing about Discord's real buckets beyond
+# backing off when we do get a 429. discord.py still does the real rate limit
+# handling underneath, so routes without an entry in route_buckets aren't
+# throttled here at all.
+class RequestScheduler:
+    POLL_EDIT = 0
+    FETCH = 1
+    CLEANUP = 2
+
+    route_buckets = {
+        "delete": (5, 5.0),
+        "bulk_delete": (1, 1.0),
+    }
+    bulk_delete_delay = 5
+    bulk_delete_limit = 100
+
+    def __init__(self):
+        self.__log = logging.getLogger(f"ocb.{__name__}")
+        self.__queue = None
+        self.__counter = itertools.count()
+        self.__buckets = {}
+        self.__new_work = None
+        self.__worker = None
+        self.__running = set()
+        self.__urgent_in_flight = 0
+        self.__pending_deletes = defaultdict(list)
+        self.__delete_timer = None
+
+    # Must be called from inside the event loop the scheduler will run on
+    def start(self):
+        if self.__worker is None:
+            self.__queue = self.__queue or asyncio.PriorityQueue()
+            self.__new_work = self.__new_work or asyncio.Event()
+            self.__worker = asyncio.ensure_future(self.__run())
+
+    def stop(self):
+        if self.__delete_timer:
+            self.__delete_timer.cancel()
+        if self.__worker is not None:
+            self.__worker.cancel()
+            self.__worker = None
+        for task in self.__running:
+            task.cancel()
+
+    # None for routes we leave entirely to discord.py
+    def bucket(self, route):
+        if route not in self.__buckets:
+            action = route[0] if isinstance(route, tuple) else route
+            limits = self.route_buckets.get(action)
+            self.__buckets[route] = RouteBucket(*limits) if limits else None
+        return self.__buckets[route]
+
+    def __enqueue(self, priority, route, func, args, kwargs):
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(route, func, args, kwargs, future)
+        self.__queue.put_nowait((priority, next(self.__counter), request))
+        self.__new_work.set()
+        return future
+
+    async def submit(self, priority, route, func, *args, **kwargs):
+        return await self.__enqueue(priority, route, func, args, kwargs)
+
+    # Fire and forget - nobody waits on the result, so failures just get logged
+    def defer(self, priority, route, func, *args, **kwargs):
+        future = self.__enqueue(priority, route, func, args, kwargs)
+        future.add_done_callback(self.__log_background_failure)
+        return future
+
+    # For work that isn't an API call itself, like walking a channel's history
+    # to find messages to delete, which shouldn't occupy a place in the queue
+    def run_in_background(self, coro):
+        task = self.__track(asyncio.ensure_future(coro))
+        task.add_done_callback(self.__log_background_failure)
+        return task
+
+    def __track(self, task):
+        self.__running.add(task)
+        task.add_done_callback(self.__running.discard)
+        return task
+
+    def defer_delete(self, messages):
+        for message in messages:
+            self.__pending_deletes[message.channel].append(message)
+
+        if self.__pending_deletes and self.__delete_timer is None:
+            self.__delete_timer = Timer(self.bulk_delete_delay, self.__flush_deletes)
+
+    def __flush_deletes(self):
+        self.__delete_timer = None
+        pending = self.__pending_deletes
+        self.__pending_deletes = defaultdict(list)
+
+        for channel, messages in pending.items():
+            self.__log.info(f"Deleting {len(messages)} messages from {channel}")
+            for i in range(0, len(messages), self.bulk_delete_limit):
+                chunk = messages[i:i + self.bulk_delete_limit]
+                self.defer(self.CLEANUP, ("bulk_delete", channel.id), self.__bulk_delete, channel, chunk)
+
+    async def __bulk_delete(self, channel, messages):
+        try:
+            await channel.delete_messages(messages)
+        except discord.HTTPException as e:
+            # Bulk deletes need Manage Messages, and refuse anything over two
+            # weeks old, so fall back to deleting one at a time
+            self.__log.info(f"Bulk delete failed ({e}) - deleting messages one by one")
+            for message in messages:
+                self.defer(self.CLEANUP, ("delete", channel.id), message.delete)
+
+    async def __run(self):
+        while True:
+            priority, seq, request = await self.__queue.get()
+            bucket = self.bucket(request.route)
+            delay = bucket.delay() if bucket else 0
+            if delay > 0:
+                self.__queue.put_nowait((priority, seq, request))
+                await self.__wait_for_work(delay)
+                continue
+
+            if priority >= self.CLEANUP and self.__urgent_in_flight:
+                # Anything more urgent is already running, or this wouldn't be
+                # at the front of the queue - wait for it to finish
+                self.__queue.put_nowait((priority, seq, request))
+                await self.__wait_for_work(None)
+                continue
+
+            if request.future.cancelled():
+                continue
+            if bucket:
+                bucket.take()
+            urgent = priority < self.CLEANUP
+            if urgent:
+                self.__urgent_in_flight += 1
+            self.__track(asyncio.ensure_future(self.__dispatch(request, urgent)))
+
+    async def __dispatch(self, request, urgent):
+        try:
+            await self.__call(request)
+        finally:
+            if urgent:
+                self.__urgent_in_flight -= 1
+                self.__new_work.set()
+
+    async def __call(self, request):
+        try:
+            result = await request.func(*request.args, **request.kwargs)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                # Start throttling this route locally even if it wasn't before
+                bucket = self.bucket(request.route) or RouteBucket(1, 1.0)
+                self.__buckets[request.route] = bucket
+                retry_after = getattr(e, "retry_after", None) or bucket.period
+                self.__log.warning(f"Rate limited on {request.route} - backing off for {retry_after}s")
+                bucket.block_for(retry_after)
+            if not request.future.cancelled():
+                request.future.set_exception(e)
+        except Exception as e:
+            if not request.future.cancelled():
+                request.future.set_exception(e)
+        else:
+            if not request.future.cancelled():
+                request.future.set_result(result)
+
+    async def __wait_for_work(self, timeout):
+        self.__new_work.clear()
+        try:
+            await asyncio.wait_for(self.__new_work.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def __log_background_failure(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            self.__log.error(f"Background request failed: {future.exception()!r}")
@@ -2,6 +2,8 @@ import os
 import logging
 import coloredlogs
 from live_bot import LiveBot
+from table_server import TableServer
+from table_solver import TableSolver
 
 TOKEN = os.environ['OCB_TOKEN']
 GUILD_ID = os.environ['OCB_GUILD_ID']
@@ -9,14 +11,29 @@ CHANNEL_NAME = os.environ['OCB_CHANNEL_NAME']
 DUMP_CHANNEL_NAME = os.environ['OCB_DUMP_CHANNEL_NAME']
 ROLE_ID = os.environ.get('OCB_ROLE_ID', 0)
 LOG_LEVEL = os.environ.get('OCB_LOG_LEVEL', 'DEBUG')
+HTTP_HOST = os.environ.get('OCB_HTTP_HOST', '0.0.0.0')
+HTTP_PORT = os.environ.get('OCB_HTTP_PORT')
+STATE_FILE = os.environ.get('OCB_STATE_FILE', 'ocb_state.json')
+GAME_SIZES_FILE = os.environ.get('OCB_GAME_SIZES_FILE')
+LOW_MEMORY = os.environ.get('OCB_LOW_MEMORY', '').lower() in ('1', 'true', 'yes')
+RSS_REPORT_INTERVAL = os.environ.get('OCB_RSS_REPORT_INTERVAL', 600 if LOW_MEMORY else 0)
+TABLE_MODE = os.environ.get('OCB_TABLE_MODE', 'image')
 
 
 def main():
     coloredlogs.install(level=LOG_LEVEL, logger=logging.getLogger('ocb'))
+    table_server = TableServer(HTTP_HOST, int(HTTP_PORT)) if HTTP_PORT else None
+    table_solver = TableSolver.from_file(GAME_SIZES_FILE) if GAME_SIZES_FILE else None
     bot = LiveBot(guild_id=int(GUILD_ID),
                   channel_name=CHANNEL_NAME,
                   dump_channel_name=DUMP_CHANNEL_NAME,
                   role_id=int(ROLE_ID),
+                  table_server=table_server,
+                  state_file=STATE_FILE or None,
+                  table_solver=table_solver,
+                  low_memory=LOW_MEMORY,
+                  rss_report_interval=float(RSS_REPORT_INTERVAL),
+                  table_mode=TABLE_MODE,
                   command_prefix='!')
     bot.run(TOKEN)
 
@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+from datetime import datetime
+
+
+# Everything LiveBot needs to pick up where it left off after a restart,
+# without rescanning the poll channel or refetching every reaction. Written on
+# shutdown and read back on the next startup; a missing or unreadable snapshot
+# just means a cold start.
+class BotSnapshot:
+    version = 1
+
+    def __init__(self, poll_message_id=None, reactions=None, table_fingerprint=None,
+                 next_reset=None, table_update_due=None, verified_role_id=None, image_cache=None):
+        self.poll_message_id = poll_message_id
+        self.reactions = reactions or {}
+        self.table_fingerprint = table_fingerprint
+        self.next_reset = next_reset
+        self.table_update_due = table_update_due
+        self.verified_role_id = verified_role_id
+        self.image_cache = image_cache or {}
+
+    def to_json(self):
+        return {
+            "version": self.version,
+            "poll_message_id": self.poll_message_id,
+            "reactions": self.reactions,
+            "table_fingerprint": self.table_fingerprint,
+            "next_reset": self.next_reset.isoformat() if self.next_reset else None,
+            "table_update_due": self.table_update_due.isoformat() if self.table_update_due else None,
+            "verified_role_id": self.verified_role_id,
+            "image_cache": self.image_cache,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        def parse_datetime(s):
+            return datetime.fromisoformat(s) if s else None
+
+        return cls(
+            poll_message_id=data.get("poll_message_id"),
+            reactions=data.get("reactions"),
+            table_fingerprint=data.get("table_fingerprint"),
+            next_reset=parse_datetime(data.get("next_reset")),
+            table_update_due=parse_datetime(data.get("table_update_due")),
+            verified_role_id=data.get("verified_role_id"),
+            image_cache=data.get("image_cache"),
+        )
+
+    def save(self, path):
+        # Write then rename, so a crash halfway through can't leave a truncated
+        # snapshot behind for the next startup to choke on
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_json(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        log = logging.getLogger(f"ocb.{__name__}")
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            log.info(f"No state snapshot at {path} - starting cold")
+            return None
+        except ValueError as e:
+            log.warning(f"Couldn't parse state snapshot at {path} - starting cold")
+            log.exception(e)
+            return None
+
+        if data.get("version") != cls.version:
+            log.warning(f"State snapshot at {path} is version {data.get('version')}, expected {cls.version} - starting cold")
+            return None
+
+        return cls.from_json(data)
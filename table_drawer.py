@@ -1,21 +1,25 @@
 from PIL import Image
 from io import BytesIO
+import hashlib
 import logging
 import requests
 import math
 import os
 
+from lru import LRUCache
+
 
 class TableDrawer:
     use_remote_emoji = False
     emoji_dir = os.path.join("data", "emoji")
     emoji_cdn_base = "https://twemoji.maxcdn.com/v/latest/72x72/"
 
-    def __init__(self, padding_width=10, square_size=128, square_padding=5):
+    def __init__(self, padding_width=10, square_size=128, square_padding=5, image_cache_size=None):
         self.__padding_width = padding_width
         self.__square_size = square_size
         self.__square_padding = square_padding
-        self.__image_cache = {}
+        self.__image_cache = LRUCache(image_cache_size)
+        self.__placeholder_urls = set()
         self.__log = logging.getLogger(f"ocb.{__name__}")
 
     @classmethod
@@ -52,16 +56,62 @@ class TableDrawer:
 
         if http_error or not response.ok:
             image = Image.new('RGBA', (self.__square_size, self.__square_size), "blue")
+            self.__placeholder_urls.add(url)
             if not http_error:
                 self.__log.error(f"Failed to get image - got response {response} from url {url}")
         else:
             image = Image.open(BytesIO(response.content))
+            self.__placeholder_urls.discard(url)
 
         image.thumbnail((self.__square_size, self.__square_size))
         image.convert("RGBA")
         self.__image_cache[url] = image
         return self.__image_cache[url]
 
+    # Which file save_cache will write each cached image to. Placeholders for
+    # images we failed to download are left out, so they get retried after a
+    # restart rather than staying blue forever.
+    def cache_index(self):
+        return {
+            url: hashlib.sha1(url.encode("utf-8")).hexdigest() + ".png"
+            for url in self.__image_cache
+            if url not in self.__placeholder_urls
+        }
+
+    # Writes the images in index into directory, and removes anything there
+    # that isn't in the index, so the directory never outgrows the cache
+    def save_cache(self, directory, index):
+        os.makedirs(directory, exist_ok=True)
+        for url, filename in index.items():
+            filepath = os.path.join(directory, filename)
+            if url not in self.__image_cache or os.path.exists(filepath):
+                continue
+            try:
+                self.__image_cache[url].save(filepath, 'PNG')
+            except Exception as e:
+                self.__log.error(f"Failed to save cached image for {url}")
+                self.__log.exception(e)
+
+        keep = set(index.values())
+        for filename in os.listdir(directory):
+            if filename not in keep:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except OSError as e:
+                    self.__log.warning(f"Couldn't remove stale cached image {filename}: {e}")
+
+    def load_cache(self, directory, index):
+        for url, filename in index.items():
+            try:
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    image = Image.open(f)
+                    image.load()
+            except Exception as e:
+                self.__log.warning(f"Couldn't load cached image for {url}: {e}")
+                continue
+            self.__image_cache[url] = image
+        self.__log.info(f"Loaded {len(self.__image_cache)} cached images from {directory}")
+
     async def user_image(self, user):
         self.__log.debug(f"Getting image for user {user}")
         return await self.image_from_url(user.display_avatar.url)
@@ -134,3 +184,24 @@ class TableDrawer:
                     out_image.paste(game_icon, coords)
 
         return out_image
+
+    # One row per game - its icon, then whoever's been seated at it. Anyone
+    # left over gets a row of their own with no icon
+    async def draw_assignment(self, assignment):
+        rows = sorted(assignment.groups.items(), key=lambda item: -len(item[1]))
+        if assignment.unassigned:
+            rows.append((None, assignment.unassigned))
+
+        num_cols = 1 + max((len(users) for _, users in rows), default=0)
+        out_image = self.new_image(num_cols, len(rows))
+
+        for row, (game, users) in enumerate(rows):
+            if game is not None:
+                game_icon = await self.react_image(game)
+                out_image.paste(game_icon, self.table_coords_to_image_coords(0, row, game_icon))
+
+            for col, user in enumerate(users):
+                avatar = await self.user_image(user)
+                out_image.paste(avatar, self.table_coords_to_image_coords(col + 1, row, avatar))
+
+        return out_image
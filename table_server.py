@@ -0,0 +1,133 @@
+import asyncio
+import hashlib
+import json
+import logging
+
+from aiohttp import web
+
+
+# Serves the most recently rendered poll table straight out of memory, so that
+# anything outside Discord which wants to show it doesn't have to scrape the
+# channel. The PNG is whatever bytes LiveBot already encoded for its upload -
+# nothing here re-renders or re-encodes anything.
+#
+#   GET /table.png               the table image, honouring If-None-Match
+#   GET /votes.json              who voted for what, honouring If-None-Match
+#   GET /table/changed?etag=...  long poll - returns as soon as the table's ETag
+#                                differs from the one given, or 304 on timeout
+#   GET /table/events            server-sent events, one per table change
+class TableServer:
+    long_poll_timeout = 30
+    keepalive_interval = 15
+
+    def __init__(self, host="0.0.0.0", port=8080):
+        self.__host = host
+        self.__port = port
+        self.__log = logging.getLogger(f"ocb.{__name__}")
+        self.__runner = None
+        self.__table_png = None
+        self.__table_etag = None
+        self.__votes_json = None
+        self.__votes_etag = None
+        self.__changed = None
+
+        self.__app = web.Application()
+        self.__app.add_routes([
+            web.get("/table.png", self.__get_table),
+            web.get("/votes.json", self.__get_votes),
+            web.get("/table/changed", self.__get_changed),
+            web.get("/table/events", self.__get_events),
+        ])
+
+    @property
+    def table_etag(self):
+        return self.__table_etag
+
+    async def start(self):
+        self.__changed = asyncio.Event()
+        self.__runner = web.AppRunner(self.__app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.__host, self.__port)
+        await site.start()
+        self.__log.info(f"Serving the poll table on http://{self.__host}:{self.__port}")
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    def publish(self, table_png, vote_matrix):
+        table_etag = self.__etag(table_png)
+        votes_json = json.dumps(vote_matrix).encode("utf-8")
+
+        self.__table_png = table_png
+        self.__votes_json = votes_json
+        self.__votes_etag = self.__etag(votes_json)
+
+        if table_etag != self.__table_etag:
+            self.__table_etag = table_etag
+            # Wake everyone waiting on the old event, and give newcomers a fresh one
+            if self.__changed is not None:
+                self.__changed.set()
+                self.__changed = asyncio.Event()
+
+    @staticmethod
+    def __etag(content):
+        return '"' + hashlib.sha1(content).hexdigest() + '"'
+
+    @staticmethod
+    def __conditional_response(request, body, etag, content_type):
+        if body is None:
+            raise web.HTTPServiceUnavailable(text="No poll table has been drawn yet")
+
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("If-None-Match", "")
+        if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type=content_type, headers=headers)
+
+    async def __get_table(self, request):
+        return self.__conditional_response(request, self.__table_png, self.__table_etag, "image/png")
+
+    async def __get_votes(self, request):
+        return self.__conditional_response(request, self.__votes_json, self.__votes_etag, "application/json")
+
+    async def __get_changed(self, request):
+        if self.__table_etag is None:
+            raise web.HTTPServiceUnavailable(text="No poll table has been drawn yet")
+
+        known_etag = request.query.get("etag") or request.headers.get("If-None-Match")
+
+        if known_etag != self.__table_etag:
+            return web.json_response({"etag": self.__table_etag})
+
+        changed = self.__changed
+        try:
+            await asyncio.wait_for(changed.wait(), self.long_poll_timeout)
+        except asyncio.TimeoutError:
+            return web.Response(status=304, headers={"ETag": self.__table_etag})
+        return web.json_response({"etag": self.__table_etag})
+
+    async def __get_events(self, request):
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+        })
+        await response.prepare(request)
+
+        sent_etag = None
+        try:
+            while True:
+                if self.__table_etag is not None and self.__table_etag != sent_etag:
+                    sent_etag = self.__table_etag
+                    await response.write(f"event: changed\ndata: {sent_etag}\n\n".encode("utf-8"))
+                    continue
+
+                changed = self.__changed
+                try:
+                    await asyncio.wait_for(changed.wait(), self.keepalive_interval)
+                except asyncio.TimeoutError:
+                    await response.write(b": keepalive\n\n")
+        except ConnectionResetError:
+            self.__log.debug("Event stream client went away")
+        return response
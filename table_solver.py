@@ -0,0 +1,309 @@
+import logging
+import random
+import time
+
+import ruamel.yaml
+
+
+def _popcount(mask):
+    return bin(mask).count("1")
+
+
+# Discord sends some emoji with a trailing variation selector and some without,
+# and people typing game_sizes.yaml won't know which, so ignore it either way
+def _normalise_name(name):
+    name = str(name)
+    if len(name) == 2 and name.endswith("\ufe0f"):
+        return name[:-1]
+    return name
+
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class TableAssignment:
+    def __init__(self, groups, unassigned, satisfied):
+        self.groups = groups
+        self.unassigned = unassigned
+        self.satisfied = satisfied
+
+    @property
+    def assigned(self):
+        return sum(len(users) for users in self.groups.values())
+
+    def __repr__(self):
+        return f"TableAssignment({len(self.groups)} games, {self.satisfied} satisfied, {len(self.unassigned)} unassigned)"
+
+
+class _Search:
+    def __init__(self, likes, voters, sizes, rng):
+        self.likes = likes
+        self.voters = voters
+        self.sizes = sizes
+        self.rng = rng
+        self.num_users = len(likes)
+        self.num_games = len(voters)
+        self.where = [-1] * self.num_users
+        self.members = [set() for _ in range(self.num_games)]
+        self.open_mask = 0
+        self.unassigned = (1 << self.num_users) - 1
+
+    def size(self, game):
+        return len(self.members[game])
+
+    def has_room(self, game):
+        return self.size(game) < self.sizes[game][1]
+
+    def can_leave(self, user):
+        game = self.where[user]
+        return game == -1 or self.size(game) > self.sizes[game][0]
+
+    def is_satisfied(self, user):
+        game = self.where[user]
+        return game != -1 and (self.likes[user] >> game) & 1
+
+    def move(self, user, game):
+        old = self.where[user]
+        if old != -1:
+            self.members[old].discard(user)
+            if not self.members[old]:
+                self.open_mask &= ~(1 << old)
+        else:
+            self.unassigned &= ~(1 << user)
+
+        self.where[user] = game
+        if game != -1:
+            self.members[game].add(user)
+            self.open_mask |= 1 << game
+        else:
+            self.unassigned |= 1 << user
+
+    def score(self):
+        satisfied = sum(1 for user in range(self.num_users) if self.is_satisfied(user))
+        assigned = self.num_users - _popcount(self.unassigned)
+        return satisfied * (self.num_users + 1) + assigned
+
+    def options(self, user, excluding=0):
+        return _popcount(self.likes[user] & ~self.open_mask & ~excluding)
+
+    def shuffled(self, iterable):
+        items = list(iterable)
+        self.rng.shuffle(items)
+        return items
+
+    # Greedily open whichever game the most unassigned people want to play,
+    # seating the people with the fewest other options first
+    def construct(self):
+        while True:
+            best = None
+            for game in _bits(~self.open_mask & ((1 << self.num_games) - 1)):
+                wanting = _popcount(self.voters[game] & self.unassigned)
+                if wanting == 0:
+                    continue
+                low, high = self.sizes[game]
+                if wanting < low and _popcount(self.unassigned) < low:
+                    continue
+                key = (wanting >= low, min(wanting, high), self.rng.random())
+                if best is None or key > best[0]:
+                    best = (key, game)
+
+            if best is None:
+                break
+            self.open_game(best[1])
+
+    def open_game(self, game):
+        low, high = self.sizes[game]
+        exclude = 1 << game
+        wanting = sorted(_bits(self.voters[game] & self.unassigned),
+                         key=lambda user: (self.options(user, exclude), self.rng.random()))
+        seated = wanting[:high]
+        if len(seated) < low:
+            others = sorted(_bits(self.unassigned & ~self.voters[game]),
+                            key=lambda user: (self.options(user, exclude), self.rng.random()))
+            seated += others[:low - len(seated)]
+        for user in seated:
+            self.move(user, game)
+
+    def fill(self):
+        for user in self.shuffled(_bits(self.unassigned)):
+            rooms = [g for g in _bits(self.open_mask) if self.has_room(g)]
+            if rooms:
+                liked = [g for g in rooms if (self.likes[user] >> g) & 1]
+                self.move(user, self.rng.choice(liked or rooms))
+
+    def try_satisfy(self, user):
+        old = self.where[user]
+        leavable = self.can_leave(user)
+
+        for game in self.shuffled(_bits(self.likes[user] & self.open_mask)):
+            if game == old:
+                continue
+
+            if self.has_room(game) and leavable:
+                self.move(user, game)
+                return True
+
+            # Swap places with someone who didn't want to play this anyway
+            for other in self.members[game]:
+                if not (self.likes[other] >> game) & 1:
+                    self.move(other, old)
+                    self.move(user, game)
+                    return True
+
+            # Or shuffle someone along to another game they also wanted
+            if leavable:
+                for other in self.members[game]:
+                    for alternative in _bits(self.likes[other] & self.open_mask & ~(1 << game)):
+                        if self.has_room(alternative) or alternative == old:
+                            self.move(other, alternative)
+                            self.move(user, game)
+                            return True
+        return False
+
+    def try_open(self, game):
+        low, high = self.sizes[game]
+        voters = self.voters[game]
+        spare = {g: self.size(g) - self.sizes[g][0] for g in _bits(self.open_mask)}
+
+        gainers = list(_bits(voters & self.unassigned))
+        neutral = []
+        for user in self.shuffled(_bits(voters & ~self.unassigned)):
+            current = self.where[user]
+            if spare[current] <= 0:
+                continue
+            if self.is_satisfied(user):
+                neutral.append(user)
+            else:
+                gainers.append(user)
+                spare[current] -= 1
+
+        gainers = gainers[:high]
+        if not gainers:
+            return False
+
+        seated = list(gainers)
+        for user in neutral:
+            if len(seated) >= low:
+                break
+            current = self.where[user]
+            if spare[current] > 0:
+                seated.append(user)
+                spare[current] -= 1
+
+        if len(seated) < low:
+            return False
+
+        for user in seated:
+            self.move(user, game)
+        return True
+
+    def improve(self, deadline):
+        improved = True
+        while improved and time.monotonic() < deadline:
+            improved = False
+            for user in self.shuffled(range(self.num_users)):
+                if not self.is_satisfied(user) and self.try_satisfy(user):
+                    improved = True
+            for game in self.shuffled(_bits(~self.open_mask & ((1 << self.num_games) - 1))):
+                if self.try_open(game):
+                    improved = True
+            self.fill()
+
+
+# Proposes who should play what, given everyone's votes. Each attendee is seated
+# at no more than one game, every game that runs has between its minimum and
+# maximum number of players, and the number of people seated at a game they
+# actually voted for is as high as we can make it - with the number of people
+# seated at all as a tie breaker. People who only thumbed-up are happy to play
+# anything.
+#
+# This is a greedy construction followed by local search, restarted with
+# different tie breaks until the time budget runs out. It isn't guaranteed to be
+# optimal, but on real polls it's hard to do better by hand.
+class TableSolver:
+    default_min_players = 2
+    default_max_players = 6
+    time_budget = 0.25
+    max_restarts = 50
+
+    def __init__(self, game_sizes=None, default_size=None, seed=None):
+        self.__game_sizes = {_normalise_name(name): size for name, size in (game_sizes or {}).items()}
+        self.__default_size = default_size or (self.default_min_players, self.default_max_players)
+        self.__seed = seed
+        self.__log = logging.getLogger(f"ocb.{__name__}")
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        with open(path, 'r') as f:
+            content = ruamel.yaml.safe_load(f) or {}
+
+        default = content.get("default") or {}
+        default_size = (default.get("min", cls.default_min_players), default.get("max", cls.default_max_players))
+        game_sizes = {
+            _normalise_name(name): (size.get("min", default_size[0]), size.get("max", default_size[1]))
+            for name, size in (content.get("games") or {}).items()
+        }
+        return cls(game_sizes, default_size, **kwargs)
+
+    def size_of(self, game_name):
+        return self.__game_sizes.get(_normalise_name(game_name), self.__default_size)
+
+    def solve(self, votes, game_name=str, time_budget=None, max_restarts=None):
+        if time_budget is None:
+            time_budget = self.time_budget
+        if max_restarts is None:
+            max_restarts = self.max_restarts
+
+        users = list(votes.keys())
+        games = []
+        game_index = {}
+        for user in users:
+            for game in votes[user]:
+                if game not in game_index:
+                    game_index[game] = len(games)
+                    games.append(game)
+
+        all_games = (1 << len(games)) - 1
+        likes = []
+        voters = [0] * len(games)
+        for user_index, user in enumerate(users):
+            mask = 0
+            for game in votes[user]:
+                mask |= 1 << game_index[game]
+            likes.append(mask or all_games)
+            for game in _bits(mask):
+                voters[game] |= 1 << user_index
+
+        sizes = []
+        for game in games:
+            low, high = self.size_of(game_name(game))
+            sizes.append((max(1, low), max(1, low, high)))
+
+        rng = random.Random(self.__seed)
+        deadline = time.monotonic() + time_budget
+        best, best_score = None, -1
+        for restart in range(max(1, max_restarts)):
+            search = _Search(likes, voters, sizes, rng)
+            search.construct()
+            search.fill()
+            search.improve(deadline)
+            score = search.score()
+            if score > best_score:
+                best, best_score = search, score
+            if time.monotonic() >= deadline:
+                break
+
+        groups = {
+            games[game]: [users[user] for user in sorted(best.members[game])]
+            for game in _bits(best.open_mask)
+        }
+        unassigned = [users[user] for user in _bits(best.unassigned)]
+        satisfied = sum(1 for user in range(len(users)) if best.is_satisfied(user))
+
+        self.__log.info(f"Seated {len(users) - len(unassigned)} of {len(users)} attendees at {len(groups)} games, "
+                        f"{satisfied} at a game they voted for ({restart + 1} restarts)")
+        return TableAssignment(groups, unassigned, satisfied)
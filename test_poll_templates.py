@@ -0,0 +1,62 @@
+from datetime import datetime
+
+import pytest
+
+from poll_templates import TemplateError, build_context, compile_template
+
+
+@pytest.fixture
+def context():
+    return build_context(datetime(2022, 10, 6), datetime(2022, 10, 13), {
+        "poll_results": [
+            {"user_id": 1, "attending": True, "votes": ["dice", "chess"]},
+            {"user_id": 2, "attending": True, "votes": ["dice"]},
+            {"user_id": 3, "attending": False, "votes": ["chess"]},
+        ]
+    })
+
+
+def test_renders_fields(context):
+    template = compile_template("{attendance} came, mostly for {top_game}, next up {next_game_date:%d/%m}")
+    assert template.render(context) == "2 came, mostly for dice, next up 13/10"
+
+
+def test_old_results_without_attending_count_everyone():
+    context = build_context(None, None, {"poll_results": [{"user_id": 1, "votes": []}]})
+    assert context["attendance"] == 1
+
+
+@pytest.mark.parametrize("source", [
+    "{__import__}",
+    "{_private}",
+    "{now.__class__}",
+    "{now._private}",
+    "{top_game.upper()}",
+    "{[x for x in top_games]}",
+    "{lambda: 1}",
+    "{attendance:{top_game}}",
+    "{attendance:999999999}",
+    "{attendance:.999999999}",
+    "{attendance!a}",
+    "{attendance",
+])
+def test_rejects_unsafe_templates(source):
+    with pytest.raises(TemplateError):
+        compile_template(source)
+
+
+@pytest.mark.parametrize("source", [
+    "{'a' * 999999999}",
+    "{999999999 * top_games}",
+    "{'%999999999d' % 1}",
+    "{attendance:zz}",
+    "{missing}",
+    "{attendance / 0}",
+])
+def test_render_failures_are_template_errors(source, context):
+    with pytest.raises(TemplateError):
+        compile_template(source).render(context)
+
+
+def test_small_repeats_are_fine(context):
+    assert compile_template("{'-' * 5}").render(context) == "-----"
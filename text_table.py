@@ -0,0 +1,117 @@
+# Renders the poll as plain text, split over as many Discord messages as it
+# takes to stay under the message length limit. Rows are streamed out one at a
+# time and packed into chunks as they come; if the table is too wide for a
+# single line, the attendees are split into several narrower tables, one after
+# the other. Every chunk repeats its table's header, so each message makes sense
+# on its own.
+#
+# Chunks are numbered rather than counted ("1", not "1/3"), so that when the
+# table grows only the chunks whose rows actually changed need editing.
+class ChunkedTextTable:
+    message_limit = 2000
+    column_separator = " | "
+    empty_message = "Nobody's voted yet"
+    min_line_width = 40
+    max_line_width = 100
+    line_width_step = 10
+
+    def __init__(self, marker, check_mark="✔", game_name=str, message_limit=None):
+        self.__marker = marker
+        self.__check_mark = check_mark
+        self.__game_name = game_name
+        self.__message_limit = message_limit or self.message_limit
+
+    def __wrap(self, index, body):
+        return f"{self.__marker} {index + 1}\n```\n{body}\n```"
+
+    def __body_limit(self):
+        # Leave room for the chunk number to grow to four digits
+        return self.__message_limit - len(self.__wrap(9999, ""))
+
+    def __column_width(self, user):
+        return len(self.column_separator) + max(len(user.name), len(self.__check_mark))
+
+    def __column_groups(self, users, label_width, line_limit):
+        groups = []
+        group = []
+        width = label_width
+        for user in users:
+            if group and width + self.__column_width(user) > line_limit:
+                groups.append(group)
+                group, width = [], label_width
+            group.append(user)
+            width += self.__column_width(user)
+        if group:
+            groups.append(group)
+        return groups
+
+    def __lines(self, table_data, games, users, label_width):
+        widths = [max(len(user.name), len(self.__check_mark)) for user in users]
+
+        header = self.column_separator.join([" " * label_width] + [u.name.center(w) for u, w in zip(users, widths)])
+        separator = "-+-".join(["-" * label_width] + ["-" * w for w in widths])
+        yield header, separator
+
+        for game in games:
+            label = (":" + self.__game_name(game) + ":").rjust(label_width)
+            cells = [(self.__check_mark if game in table_data[user] else "").center(w) for user, w in zip(users, widths)]
+            yield self.column_separator.join([label] + cells).rstrip(), None
+
+    def __sorted(self, table_data):
+        games = set()
+        users = list(table_data.keys())
+        for reacts in table_data.values():
+            games |= set(reacts)
+        games = sorted(games, key=self.__game_name)
+        users.sort(key=lambda x: x.name)
+        return games, users
+
+    def rows(self, table_data, line_limit=None):
+        games, users = self.__sorted(table_data)
+        label_width = max([len(self.__game_name(g)) + 2 for g in games] + [0])
+        for group in self.__column_groups(users, label_width, line_limit or self.max_line_width):
+            yield from self.__lines(table_data, games, group, label_width)
+
+    def __pack(self, rows):
+        body_limit = self.__body_limit()
+        chunks = []
+        current = []
+        current_length = 0
+        header = []
+
+        for line, separator in rows:
+            if separator is not None:
+                # A new column group carries on in the current chunk if its
+                # header and at least one row would still fit there
+                header = [line, separator]
+                header_length = len(line) + len(separator) + 1
+                if current and current_length + 2 * len(line) + len(separator) + 3 > body_limit:
+                    chunks.append("\n".join(current))
+                    current, current_length = [], -1
+                current += header
+                current_length += header_length + 1
+                continue
+
+            if current_length + len(line) + 1 > body_limit and len(current) > len(header):
+                chunks.append("\n".join(current))
+                current = list(header)
+                current_length = sum(len(h) + 1 for h in header) - 1
+            current.append(line)
+            current_length += len(line) + 1
+
+        if current:
+            chunks.append("\n".join(current))
+        return chunks
+
+    # Wider lines mean fewer repeated labels and headers, but a group's rows
+    # all have to fit alongside its header, so try a few widths and keep
+    # whichever needs the fewest messages
+    def chunks(self, table_data):
+        best = None
+        for line_limit in range(self.max_line_width, self.min_line_width - 1, -self.line_width_step):
+            chunks = self.__pack(self.rows(table_data, line_limit))
+            if best is None or len(chunks) < len(best):
+                best = chunks
+        if not best:
+            best = [self.empty_message]
+        return [self.__wrap(index, body) for index, body in enumerate(best)]